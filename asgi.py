@@ -0,0 +1,326 @@
+#!python3
+
+"""
+ASGI app for async serving mode
+I/O-bound routes run on the event loop and page rendering in processes;
+the other routes are served by the Flask app in a pool of threads.
+"""
+
+import os
+import time
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.middleware import Middleware
+from starlette.responses import FileResponse, Response
+from starlette.routing import Mount, Route
+from starlette.staticfiles import StaticFiles
+from a2wsgi import WSGIMiddleware
+from PIL import Image
+
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+import metrics
+from db_pool import pool
+from server import app as flask_app, ext_mimetypes
+from render_queue import RenderQueue, Overloaded, DeadlineExceeded
+from tools import (
+    BOOK_FILE_ERRORS,
+    book_file,
+    select_books,
+    precompressed_variant,
+    render_page,
+    thumbnail_path,
+    make_thumbnails,
+    thumbsheet_key,
+    thumbsheet_path,
+    make_thumbsheet,
+    manifest_path,
+    make_manifest,
+    render_tile,
+    tile_path,
+)
+from settings import (
+    IMG_MIMETYPES,
+    THUMB_SIZES,
+    THUMBSHEET_MAX,
+    RAW_DELIVERY,
+    X_ACCEL_PREFIX,
+    PRECOMPRESS_FILETYPES,
+    RENDER_PROCESSES,
+    RENDER_QUEUE_SIZE,
+    RENDER_DEADLINE,
+    RENDER_PRELOAD_DEADLINE,
+    RENDER_RETRY_AFTER,
+    FLASK_THREADS,
+)
+
+# CPU-heavy tasks run apart from the event loop. Processes are not forked
+# from this one, whose threads (Flask, DB pool) may hold locks at the time.
+render_context = multiprocessing.get_context("forkserver")
+render_context.set_forkserver_preload(["tools", "metrics"])
+render_pool = ProcessPoolExecutor(RENDER_PROCESSES, mp_context=render_context)
+render_queue = RenderQueue(render_pool, RENDER_PROCESSES, RENDER_QUEUE_SIZE)
+
+
+def run_db(func, *args, **kwargs):
+    """Run func(*args, database=...) in a thread, with a read-only connection"""
+
+    def run():
+        with pool.reader() as database:
+            return func(*args, database=database, **kwargs)
+
+    return asyncio.to_thread(run)
+
+
+async def in_process(func, *args):
+    """Run func(*args) in the render processes"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(render_pool, metrics.run_and_flush, func, *args)
+
+
+async def render_for(request, func, *args):
+    """
+    Run func(*args) through the render queue.
+    Preloads (X-Render-Priority: low) yield to the pages being viewed, and
+    the job is cancelled when the client goes away (then returns None).
+    """
+    if request.headers.get("x-render-priority") == "low":
+        priority, timeout = 1, RENDER_PRELOAD_DEADLINE
+    else:
+        priority, timeout = 0, RENDER_DEADLINE
+
+    async def disconnected():
+        while (await request.receive())["type"] != "http.disconnect":
+            pass
+
+    job = asyncio.create_task(
+        render_queue.submit(
+            metrics.run_and_flush, func, *args, priority=priority, timeout=timeout
+        )
+    )
+    watcher = asyncio.create_task(disconnected())
+    await asyncio.sleep(0)  # Let the job enter the queue
+    metrics.set_gauge("fmfm_render_queue_depth", len(render_queue))
+    await asyncio.wait((job, watcher), return_when=asyncio.FIRST_COMPLETED)
+    watcher.cancel()
+    metrics.set_gauge("fmfm_render_queue_depth", len(render_queue))
+    if not job.done():
+        job.cancel()  # Abandoned: nobody will see the result
+        return None
+    return job.result()
+
+
+def accepts_webp(request):
+    """True if the browser accepts WebP"""
+    return parse_accept_header(request.headers.get("accept"), MIMEAccept)["image/webp"]
+
+
+async def raw(request):
+    """Original file, with range requests and precompressed variants"""
+    number = request.path_params["number"]
+    try:
+        file_real, filetype = await run_db(book_file, number)
+    except IndexError as exc:
+        raise HTTPException(404) from exc
+    filename = os.path.basename(file_real)
+    mimetype = ext_mimetypes.get(filetype, "application/octet-stream")
+
+    # Web server sends the file
+    if RAW_DELIVERY == "x-accel-redirect":
+        headers = {"X-Accel-Redirect": X_ACCEL_PREFIX + filename}
+        return Response(headers=headers, media_type=mimetype)
+    if RAW_DELIVERY == "x-sendfile":
+        return Response(headers={"X-Sendfile": file_real}, media_type=mimetype)
+
+    accept_encodings = parse_accept_header(request.headers.get("accept-encoding"))
+    file_real, encoding = precompressed_variant(file_real, filetype, accept_encodings)
+
+    headers = {"Cache-Control": "max-age=3000"}
+    if filetype in PRECOMPRESS_FILETYPES:
+        headers["Vary"] = "Accept-Encoding"
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+
+    # Range and If-Range are handled by FileResponse
+    return FileResponse(
+        file_real,
+        media_type=mimetype,
+        headers=headers,
+        filename=filename,
+        content_disposition_type="inline",
+    )
+
+
+async def page_image(request):
+    """Shrink or rendered image from pdf/zip"""
+    number, page = request.path_params["number"], request.path_params["page"]
+    query = request.query_params.get("query", "")
+
+    try:
+        _, filetype = await run_db(book_file, number)
+        rendered = await render_for(request, render_page, number, filetype, page, query)
+    except (IndexError, TypeError) as exc:
+        raise HTTPException(404) from exc
+    except Image.DecompressionBombError as exc:
+        raise HTTPException(422) from exc  # Too big to decode
+    except (Overloaded, DeadlineExceeded) as exc:
+        metrics.inc("fmfm_render_refused_total", reason=type(exc).__name__)
+        headers = {"Retry-After": str(RENDER_RETRY_AFTER)}
+        raise HTTPException(503, headers=headers) from exc
+
+    if rendered is None:
+        metrics.inc("fmfm_render_abandoned_total")
+        return Response(status_code=499)  # Client closed the request
+    # Chunks were copied when sent from the render process; joined once here
+    chunks, imgtype = rendered
+    headers = {"Cache-Control": "max-age=3000"}
+    return Response(
+        b"".join(chunks), media_type=IMG_MIMETYPES[imgtype], headers=headers
+    )
+
+
+async def tile(request):
+    """Tile of the page for deep zoom, rendered when missing"""
+    params = request.path_params
+    number, page = params["number"], params["page"]
+    z, x, y = params["z"], params["x"], params["y"]
+    tile_real = tile_path(number, page, z, x, y)
+
+    metrics.cache_result("tile", os.path.exists(tile_real))
+    if not os.path.exists(tile_real):
+        try:
+            _, filetype = await run_db(book_file, number)
+            rendered = await render_for(
+                request, render_tile, number, filetype, page, z, x, y
+            )
+        except BOOK_FILE_ERRORS as exc:
+            raise HTTPException(404) from exc
+        except Image.DecompressionBombError as exc:
+            raise HTTPException(422) from exc  # Too big to decode
+        except (Overloaded, DeadlineExceeded) as exc:
+            metrics.inc("fmfm_render_refused_total", reason=type(exc).__name__)
+            headers = {"Retry-After": str(RENDER_RETRY_AFTER)}
+            raise HTTPException(503, headers=headers) from exc
+
+        if rendered is None:
+            metrics.inc("fmfm_render_abandoned_total")
+            return Response(status_code=499)  # Client closed the request
+
+    headers = {"Cache-Control": "max-age=86400"}
+    return FileResponse(tile_real, media_type="image/jpeg", headers=headers)
+
+
+async def thumbnail(request):
+    """Thumbnail image (WebP if the browser accepts)"""
+    number, size = request.path_params["number"], request.path_params["size"]
+    if size not in THUMB_SIZES:
+        raise HTTPException(404)
+
+    imgtype = "webp" if accepts_webp(request) else "jpeg"
+    thumb_real = thumbnail_path(number, size, imgtype)
+
+    metrics.cache_result("thumbnail", os.path.exists(thumb_real))
+    if not os.path.exists(thumb_real):
+        try:
+            _, filetype = await run_db(book_file, number)
+            await in_process(make_thumbnails, number, filetype)
+        except BOOK_FILE_ERRORS as exc:
+            raise HTTPException(404) from exc
+
+    headers = {"Cache-Control": "max-age=3000", "Vary": "Accept"}
+    return FileResponse(thumb_real, media_type=IMG_MIMETYPES[imgtype], headers=headers)
+
+
+async def thumbsheet(request):
+    """Sprite sheet of thumbnails, cached by book numbers and md5s"""
+    try:
+        ids = request.query_params.get("ids", "")
+        numbers = [int(n) for n in ids.split(",")][:THUMBSHEET_MAX]
+    except ValueError as exc:
+        raise HTTPException(404) from exc
+
+    entries = await run_db(select_books, numbers, columns="number, md5, filetype")
+    if not entries:
+        raise HTTPException(404)
+
+    imgtype = "webp" if accepts_webp(request) else "jpeg"
+    key = thumbsheet_key((e["number"], e["md5"]) for e in entries)
+    sheet_real = thumbsheet_path(key, imgtype)
+    metrics.cache_result("thumbsheet", os.path.exists(sheet_real))
+    if not os.path.exists(sheet_real):
+        sheet_entries = [(e["number"], e["filetype"]) for e in entries]
+        await in_process(make_thumbsheet, sheet_entries, sheet_real, imgtype)
+
+    headers = {"Cache-Control": "max-age=86400", "Vary": "Accept"}
+    return FileResponse(sheet_real, media_type=IMG_MIMETYPES[imgtype], headers=headers)
+
+
+async def manifest(request):
+    """Page manifest of pdf/zip (JSON), made when missing"""
+    number = request.path_params["number"]
+    manifest_real = manifest_path(number)
+
+    metrics.cache_result("manifest", os.path.exists(manifest_real))
+    if not os.path.exists(manifest_real):
+        try:
+            _, filetype = await run_db(book_file, number)
+            await in_process(make_manifest, number, filetype)
+        except BOOK_FILE_ERRORS as exc:
+            raise HTTPException(404) from exc
+
+    headers = {"Cache-Control": "max-age=3000"}
+    return FileResponse(manifest_real, media_type="application/json", headers=headers)
+
+
+class MetricsMiddleware:
+    """Latency, status and bytes of the async routes (Flask counts its own)"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        status, sent = 500, 0
+
+        async def counting_send(message):
+            nonlocal status, sent
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, counting_send)
+        finally:
+            # Routes have endpoint functions; mounted apps are not counted
+            route = getattr(scope.get("endpoint"), "__name__", None)
+            if route is not None:
+                elapsed = time.perf_counter() - started
+                metrics.observe("fmfm_request_seconds", elapsed, route=route)
+                metrics.inc("fmfm_requests_total", route=route, status=status)
+                metrics.inc("fmfm_response_bytes_total", sent, route=route)
+                metrics.flush()
+
+
+app = Starlette(
+    routes=[
+        Route("/raw/{number:int}", raw),
+        Route("/img/{number:int}/{page:int}", page_image),
+        Route("/tile/{number:int}/{page:int}/{z:int}/{x:int}/{y:int}", tile),
+        Route("/thumb/{number:int}/{size}", thumbnail),
+        Route("/thumbsheet", thumbsheet),
+        Route("/manifest/{number:int}", manifest),
+        Mount("/static", app=StaticFiles(directory=flask_app.static_folder)),
+        Mount("/", app=WSGIMiddleware(flask_app, workers=FLASK_THREADS)),
+    ],
+    middleware=[Middleware(MetricsMiddleware)],
+)
@@ -0,0 +1,751 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for FMFM, on synthetic files made offline (same seed, same files)
+benchmark.py ingest ......... registering and indexing throughput, DB size
+benchmark.py render ......... page rendering latency of PDF/zip
+benchmark.py search ......... /search latency (with filters) by corpus size
+benchmark.py all ............ all the above
+benchmark.py epub_chunking .. text index of EPUB, fixed split vs. by length
+benchmark.py clean_ocr ...... OCR text cleanup, same output as before and speed
+benchmark.py import_time .... start-up of server and CLI, within the budget
+Options: --save=FILE stores the results as a baseline,
+         --compare=FILE compares with a baseline (--tolerance=0.2 is 20%).
+"""
+
+import os
+import io
+import re
+import sys
+import json
+import math
+import random
+import sqlite3
+import shutil
+import subprocess
+import zipfile
+import platform
+import statistics
+import tempfile
+import time
+import unicodedata
+from functools import partial
+
+from PIL import Image, ImageDraw
+
+import tools
+import metrics
+from tools import chunk_text, ngram_if_2byte, n_gram
+from tools import clean_ocr_text, clean_ocr_pages, TWOBYTE_CHARS
+from tools import register_file, refresh_entry, store_entry, render_page
+from settings import EPUB_CHUNK_CHARS, SCHEMA_PATH
+
+# ---- SYNTHETIC TEXT ---- #
+# Vocabulary of pseudo words; picked with Zipf-like frequency
+SYLLABLES = "ka ri to mo ne su la vi den por ast el im un qua ter".split()
+LATIN_WORDS = sorted(
+    {"".join(random.Random(i).choices(SYLLABLES, k=1 + i % 4)) for i in range(5000)}
+)
+CJK_CHARS = [chr(c) for c in range(0x4E00, 0x4E00 + 3000)]
+
+
+def zipf_choice(rng, vocabulary):
+    """Frequent words come first in the vocabulary"""
+    return vocabulary[min(int(rng.paretovariate(1.0)) - 1, len(vocabulary) - 1)]
+
+
+def synthetic_paragraph(rng, length, cjk=False):
+    """Random paragraph of about the length"""
+    if cjk:
+        return "".join(zipf_choice(rng, CJK_CHARS) for _ in range(length))
+    words = []
+    while sum(len(w) + 1 for w in words) < length:
+        words.append(zipf_choice(rng, LATIN_WORDS))
+    return " ".join(words)
+
+
+def synthetic_sections(rng, cjk=False):
+    """Spine items of a book: title pages, chapters and a very long one"""
+    sizes = [200, 500, 1_500] + [rng.randint(5_000, 60_000) for _ in range(20)]
+    sizes.append(300_000)
+    sections = []
+    for size in sizes:
+        paragraphs = []
+        while sum(len(p) for p in paragraphs) < size:
+            paragraphs.append(synthetic_paragraph(rng, rng.randint(50, 800), cjk))
+        sections.append("\n".join(paragraphs))
+    return sections
+
+
+def synthetic_words(rng, n, cjk=False):
+    """Short line of words (CJK: characters)"""
+    if cjk:
+        return "".join(zipf_choice(rng, CJK_CHARS) for _ in range(n))
+    return " ".join(zipf_choice(rng, LATIN_WORDS) for _ in range(n))
+
+
+# ---- SYNTHETIC FILES ---- #
+def write_pdf(path, rng, pages=20):
+    """
+    PDF with text pages, written by hand (no PDF library needed).
+    Latin only: CJK text needs embedded fonts, so CJK is left to other types.
+    """
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None]
+    objects.append("<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    kids = []
+    for _ in range(pages):
+        lines = [synthetic_paragraph(rng, 80) for _ in range(45)]
+        escaped = (
+            l.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+            for l in lines
+        )
+        text = " T* ".join(f"({l}) Tj" for l in escaped)
+        stream = f"BT /F1 10 Tf 14 TL 50 800 Td {text} ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        objects.append(
+            "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>"
+        )
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {pages} >>"
+
+    pdf = io.BytesIO()
+    pdf.write(b"%PDF-1.4\n")
+    offsets = []
+    for i, obj in enumerate(objects, start=1):
+        offsets.append(pdf.tell())
+        pdf.write(f"{i} 0 obj\n{obj}\nendobj\n".encode("latin-1"))
+    xref = pdf.tell()
+    pdf.write(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode())
+    pdf.write("".join(f"{o:010d} 00000 n \n" for o in offsets).encode())
+    pdf.write(
+        f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\n"
+        f"startxref\n{xref}\n%%EOF\n".encode()
+    )
+    with open(path, "wb") as f:
+        f.write(pdf.getvalue())
+
+
+def write_zip(path, rng, pages=20, size=(1200, 1700)):
+    """Zip of scanned-like JPEG pages (noise, frames and text lines)"""
+    with zipfile.ZipFile(path, "w") as archive:
+        for p in range(pages):
+            img = Image.effect_noise(size, rng.randint(20, 60)).convert("RGB")
+            draw = ImageDraw.Draw(img)
+            draw.rectangle((60, 60, size[0] - 60, size[1] - 60), outline=(20, 20, 20))
+            for y in range(100, size[1] - 100, 40):
+                draw.text((100, y), synthetic_words(rng, 10), fill=(0, 0, 0))
+            jpeg = io.BytesIO()
+            img.save(jpeg, "JPEG", quality=85)
+            archive.writestr(f"{p + 1}.jpg", jpeg.getvalue())
+
+
+def write_epub(path, rng, cjk=False, chapters=10):
+    """EPUB3 with chapters of paragraphs and a cover image"""
+    container = (
+        '<?xml version="1.0"?><container version="1.0" '
+        'xmlns="urn:oasis:names:tc:opendocument:xmlns:container"><rootfiles>'
+        '<rootfile full-path="OEBPS/content.opf" '
+        'media-type="application/oebps-package+xml"/></rootfiles></container>'
+    )
+    items = [
+        '<item id="cover" href="cover.jpg" media-type="image/jpeg" '
+        'properties="cover-image"/>'
+    ]
+    refs = []
+    documents = {}
+    for c in range(chapters):
+        paragraphs = "".join(
+            f"<p>{synthetic_paragraph(rng, rng.randint(50, 800), cjk)}</p>"
+            for _ in range(rng.randint(10, 60))
+        )
+        documents[f"OEBPS/c{c}.xhtml"] = (
+            '<?xml version="1.0"?><html xmlns="http://www.w3.org/1999/xhtml">'
+            f"<head><title>{c}</title></head><body><h1>{c}</h1>{paragraphs}</body></html>"
+        )
+        items.append(
+            f'<item id="c{c}" href="c{c}.xhtml" media-type="application/xhtml+xml"/>'
+        )
+        refs.append(f'<itemref idref="c{c}"/>')
+    opf = (
+        '<?xml version="1.0"?><package xmlns="http://www.idpf.org/2007/opf" '
+        'version="3.0"><metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+        f"<dc:title>{synthetic_words(rng, 4, cjk)}</dc:title></metadata>"
+        f"<manifest>{''.join(items)}</manifest><spine>{''.join(refs)}</spine></package>"
+    )
+    cover = io.BytesIO()
+    Image.effect_noise((600, 900), 40).convert("RGB").save(cover, "JPEG")
+
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("mimetype", "application/epub+zip", zipfile.ZIP_STORED)
+        archive.writestr("META-INF/container.xml", container)
+        archive.writestr("OEBPS/content.opf", opf)
+        archive.writestr("OEBPS/cover.jpg", cover.getvalue())
+        for name, document in documents.items():
+            archive.writestr(name, document)
+
+
+def write_markdown(path, rng, cjk=False, sections=10):
+    """Markdown note of headings, paragraphs and lists"""
+    with open(path, "w", encoding="utf-8") as f:
+        for _ in range(sections):
+            f.write(f"## {synthetic_words(rng, 4, cjk)}\n\n")
+            f.write(synthetic_paragraph(rng, rng.randint(200, 1500), cjk) + "\n\n")
+            f.write("".join(f"* {synthetic_words(rng, 6, cjk)}\n" for _ in range(5)))
+            f.write("\n")
+
+
+def synthetic_library(directory, n_books):
+    """
+    Files of each type -> {filetype: [path...]}
+    EPUB and markdown alternate between Latin and CJK text.
+    """
+    rng = random.Random(0)
+    library = {"pdf": [], "zip": [], "epub": [], "md": []}
+    for i in range(n_books):
+        cjk = i % 2 == 1
+        for filetype, writer in (
+            ("pdf", write_pdf),
+            ("zip", write_zip),
+            ("epub", partial(write_epub, cjk=cjk)),
+            ("md", partial(write_markdown, cjk=cjk)),
+        ):
+            path = os.path.join(directory, f"{filetype}_{i}.{filetype}")
+            writer(path, rng)
+            library[filetype].append(path)
+    return library
+
+
+# Library in a scratch directory
+SANDBOX_PATHS = (
+    "UPLOADDIR_PATH",
+    "THUMBDIR_PATH",
+    "THUMBSHEET_DIR",
+    "MD_CACHE_PATH",
+    "LINEARIZED_DIR",
+    "MANIFEST_DIR",
+    "TILE_DIR",
+)
+
+
+def sandbox(root):
+    """Point tools at an empty library under root (the real one is untouched)"""
+    for name in SANDBOX_PATHS:
+        setattr(tools, name, os.path.join(root, name.lower()))
+        os.makedirs(getattr(tools, name), exist_ok=True)
+    metrics.METRICS_DIR = os.path.join(root, "metrics_dir")
+    tools.DATABASE_PATH = os.path.join(root, "data.db")
+    tools.filetypes.clear()
+    tools.load_manifest_cached.cache_clear()
+
+    db = sqlite3.connect(tools.DATABASE_PATH)
+    db.row_factory = sqlite3.Row
+    with open(SCHEMA_PATH, encoding="utf-8") as f:
+        db.executescript(f.read())
+    return db
+
+
+def ingest(library, db):
+    """Register and index the files -> {filetype: (seconds, bytes, [numbers])}"""
+    results = {}
+    for filetype, paths in library.items():
+        numbers = []
+        start = time.perf_counter()
+        try:
+            for path in paths:
+                number = register_file(path, database=db)
+                refresh_entry(number, database=db)
+                numbers.append(number)
+        except Exception as e:  # e.g. missing font or library
+            print(f"{filetype}: skipped ({type(e).__name__}: {e})")
+            continue
+        elapsed = time.perf_counter() - start
+        results[filetype] = (elapsed, sum(os.path.getsize(p) for p in paths), numbers)
+    return results
+
+
+def db_size(db):
+    """Bytes used by the DB"""
+    pages = db.execute("pragma page_count").fetchone()[0]
+    return pages * db.execute("pragma page_size").fetchone()[0]
+
+
+def percentile(values, p):
+    """p-th percentile (nearest rank)"""
+    values = sorted(values)
+    return values[min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1)]
+
+
+# ---- CHUNKERS ---- #
+def fixed_split_chunks(text, split=100):
+    """Former way: every item is split into the fixed number of chunks"""
+    chunk_length = math.ceil(len(text) / split)
+    for p, i in enumerate(range(0, len(text), chunk_length)):
+        yield round(p / split, 2), text[i : i + chunk_length]
+
+
+def length_chunks(text, size=EPUB_CHUNK_CHARS):
+    """Current way: chunks of about the size at paragraph boundaries"""
+    for offset, chunk in chunk_text(text, size=size):
+        yield min(round(offset / len(text), 3), 0.999), chunk
+
+
+def build_index(books, chunker):
+    """In-memory FTS table of the books"""
+    db = sqlite3.connect(":memory:")
+    db.execute("create virtual table fts using fts5(number, page, ngram)")
+    for number, sections in enumerate(books, start=1):
+        rows = [
+            (number, pos + minipos, ngram_if_2byte(chunk.replace("\n", " ")))
+            for pos, text in enumerate(sections)
+            for minipos, chunk in chunker(text)
+        ]
+        db.executemany("insert into fts (number, page, ngram) values (?, ?, ?)", rows)
+    db.execute("insert into fts (fts) values ('optimize')")  # Merge segments
+    db.commit()
+    return db
+
+
+def query_latency(db, queries, repeat=5):
+    """Median seconds of bm25-ordered search"""
+    timings = []
+    for _ in range(repeat):
+        for q in queries:
+            start = time.perf_counter()
+            db.execute(
+                "select * from fts where ngram match ? order by bm25(fts) limit 500",
+                (q,),
+            ).fetchall()
+            timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def bench_epub_chunking(args):
+    """
+    Index size and query latency: fixed split vs. length based chunks
+    benchmark.py epub_chunking [number of books] [chunk length ...]
+    """
+    n_books = int(args[0]) if args else 10
+    sizes = [int(a) for a in args[1:]] or [EPUB_CHUNK_CHARS]
+    rng = random.Random(0)
+    books = [synthetic_sections(rng, cjk=(i % 2 == 1)) for i in range(n_books)]
+    # Frequent to rare words
+    queries = [f'"{LATIN_WORDS[i]}"' for i in (0, 10, 100, 1000)]
+    queries += [f'"{n_gram(CJK_CHARS[i] + CJK_CHARS[i + 1])}"' for i in (0, 10, 100)]
+
+    print(f"{n_books} synthetic books, {len(books[0])} spine items each")
+    print(f"{'chunker':<14}{'rows':>10}{'DB size (KiB)':>16}{'query (ms)':>12}")
+    chunkers = [("fixed split", fixed_split_chunks)]
+    chunkers += [(f"length {s}", partial(length_chunks, size=s)) for s in sizes]
+    for name, chunker in chunkers:
+        db = build_index(books, chunker)
+        rows = db.execute("select count(*) from fts").fetchone()[0]
+        pages = db.execute("pragma page_count").fetchone()[0]
+        page_size = db.execute("pragma page_size").fetchone()[0]
+        latency = query_latency(db, queries)
+        print(
+            f"{name:<14}{rows:>10}{pages * page_size / 1024:>16.0f}{latency * 1000:>12.2f}"
+        )
+        db.close()
+
+
+def bench_ingest(args):
+    """
+    Books per second, MB per second and DB size of registering and indexing
+    benchmark.py ingest [books per filetype]
+    """
+    n_books = int(args[0]) if args else 4
+    results = {}
+    with tempfile.TemporaryDirectory() as root:
+        inbox = os.path.join(root, "inbox")
+        os.makedirs(inbox)
+        library = synthetic_library(inbox, n_books)
+        db = sandbox(root)
+
+        print(f"{'filetype':<10}{'books/s':>10}{'MB/s':>10}")
+        for filetype, (elapsed, size, numbers) in ingest(library, db).items():
+            print(
+                f"{filetype:<10}{len(numbers) / elapsed:>10.2f}"
+                f"{size / elapsed / 1e6:>10.2f}"
+            )
+            results[f"ingest.{filetype}.ms_per_book"] = elapsed / len(numbers) * 1000
+        results["ingest.db_kib"] = db_size(db) / 1024
+        print(f"DB size: {results['ingest.db_kib']:.0f} KiB")
+        db.close()
+    return results
+
+
+def bench_render(args):
+    """
+    Median and 95th percentile of page rendering (as sent by /img)
+    benchmark.py render [books per filetype] [pages per book]
+    """
+    n_books = int(args[0]) if args else 2
+    n_pages = int(args[1]) if len(args) > 1 else 10
+    results = {}
+    with tempfile.TemporaryDirectory() as root:
+        inbox = os.path.join(root, "inbox")
+        os.makedirs(inbox)
+        library = synthetic_library(inbox, n_books)
+        library = {k: library[k] for k in ("pdf", "zip")}
+        db = sandbox(root)
+
+        print(f"{'filetype':<10}{'median (ms)':>14}{'p95 (ms)':>12}")
+        for filetype, (_, _, numbers) in ingest(library, db).items():
+            render_page(numbers[0], filetype, 0)  # Warm up
+            timings = []
+            for number in numbers:
+                for page in range(n_pages):
+                    start = time.perf_counter()
+                    render_page(number, filetype, page)
+                    timings.append(time.perf_counter() - start)
+            median, p95 = statistics.median(timings), percentile(timings, 95)
+            print(f"{filetype:<10}{median * 1000:>14.1f}{p95 * 1000:>12.1f}")
+            results[f"render.{filetype}.median_ms"] = median * 1000
+            results[f"render.{filetype}.p95_ms"] = p95 * 1000
+        db.close()
+    return results
+
+
+# Tags and filetypes of the books in the search benchmark
+SEARCH_TAGS = ("novel", "manual", "comic", "paper", "memo")
+SEARCH_FILETYPES = ("epub", "md", "pdf")
+
+
+def search_library(root, books):
+    """Sandbox DB of the text books, stored as indexing does (store_entry)"""
+    rng = random.Random(0)
+    db = sandbox(root)
+    cursor = db.cursor()
+    for number, sections in enumerate(books, start=1):
+        cjk = number % 2 == 0
+        cursor.execute(
+            "insert into books (number, title, tags, filetype, registered_date)"
+            " values (?, ?, ?, ?, ?)",
+            (
+                number,
+                synthetic_words(rng, 4, cjk=cjk),
+                " ".join(rng.sample(SEARCH_TAGS, 2)),
+                SEARCH_FILETYPES[number % len(SEARCH_FILETYPES)],
+                f"2024-{number % 12 + 1:02d}-01",
+            ),
+        )
+        cursor.execute("select * from books where number = ?", (number,))
+        rows = [
+            (number, pos + minipos, ngram_if_2byte(chunk.replace("\n", " ")))
+            for pos, text in enumerate(sections)
+            for minipos, chunk in length_chunks(text)
+        ]
+        extracted = {"pagenum": len(sections), "title": None, "md5": ""}
+        store_entry(cursor.fetchone(), extracted | {"index_data": rows}, cursor)
+    cursor.execute("insert into fts (fts) values ('optimize')")  # Merge segments
+    db.commit()
+    return db
+
+
+def search_latency(client, params, repeat=5):
+    """Median seconds of the /search view"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = client.get("/search", query_string=params)
+        timings.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            raise RuntimeError(f"/search answered {response.status_code}")
+    return statistics.median(timings)
+
+
+def bench_search(args):
+    """
+    Latency of the /search view (full text, title and tags, filters, facets
+    and excerpts) and DB size by the number of books (EPUB-like text)
+    benchmark.py search [number of books ...]
+    """
+    from db_pool import ConnectionPool
+
+    sizes = [int(a) for a in args] or [5, 10, 20]
+    rng = random.Random(0)
+    queries = {
+        "latin_frequent": {"query": LATIN_WORDS[0]},
+        "latin_rare": {"query": LATIN_WORDS[1000]},
+        "cjk_frequent": {"query": CJK_CHARS[0] + CJK_CHARS[1]},
+        "cjk_rare": {"query": CJK_CHARS[100] + CJK_CHARS[101]},
+        "filtered": {
+            "query": LATIN_WORDS[0],
+            "tag": SEARCH_TAGS[0],
+            "filetype": SEARCH_FILETYPES[0],
+            "date_from": "2024-03-01",
+        },
+    }
+    books = []
+    results = {}
+    print(f"{'books':>8}{'DB size (KiB)':>16}" + "".join(f"{q:>16}" for q in queries))
+    for size in sizes:
+        while len(books) < size:
+            books.append(synthetic_sections(rng, cjk=len(books) % 2 == 1))
+        with tempfile.TemporaryDirectory() as root:
+            db = search_library(root, books[:size])
+            # Flask app, imported once in the sandbox (it initializes the DB)
+            import server
+
+            server.pool = ConnectionPool(tools.DATABASE_PATH)
+            client = server.app.test_client()
+            latencies = {
+                q: search_latency(client, params) * 1000
+                for q, params in queries.items()
+            }
+            kib = db_size(db) / 1024
+            db.close()
+        print(
+            f"{size:>8}{kib:>16.0f}"
+            + "".join(f"{v:>16.2f}" for v in latencies.values())
+        )
+        results[f"search.{size}.db_kib"] = kib
+        for q, latency in latencies.items():
+            results[f"search.{size}.{q}_ms"] = latency
+    return results
+
+
+def bench_all(args):
+    """Ingest, render and search with default sizes"""
+    results = {}
+    for bench in (bench_ingest, bench_render, bench_search):
+        print(f"---- {bench.__name__[6:]} ----")
+        results.update(bench([]))
+    return results
+
+
+# ---- OCR TEXT CLEANUP ---- #
+def clean_ocr_text_former(t):
+    """Former clean_ocr_text: the output must stay the same"""
+    t = "".join(t.splitlines()).strip()
+    t = re.sub("[ 　\t,\"'●■□一]+", " ", t)
+    t = re.sub(". . ", "", t)
+    for _ in range(3):
+        t = re.sub(f"({TWOBYTE_CHARS}+)[ \t　]({TWOBYTE_CHARS}+)", "\\1\\2", t)
+    t = unicodedata.normalize("NFKC", t)
+    t = re.sub(r"[\.,\"'●■□~=ー\−][\.,\"'●■□~=ー\−]+", "", t)
+    return t
+
+
+# Pieces of dirty OCR text: scripts, separators, dots, ligatures, line breaks
+OCR_PIECES = (
+    list("あいうえおカキクケコ漢字一二三々〇、。「」・ーｰ－−")
+    + list(" 　\t,\"'●■□~=.．,，ﬁﬂ①㍻ＡＢ\xa0")
+    + ["\n", "\r\n", "\u2028", "\u0301", ". . ", "abc", "OCR", "123"]
+)
+
+
+# Corner cases
+OCR_CASES = [
+    "",
+    " \t\n　",
+    "あ い う え お か き く け こ",
+    "漢 字\n\nか な\r\nカ ナ",
+    "。 、 「 」 々 〇",
+    ". . . . ....",
+    "ﬁle ﬂow ①，，．．",
+    ",leading and trailing,",
+]
+
+
+def synthetic_ocr_page(rng, length=2000):
+    """Random dirty page, with runs of spaced kana and dots"""
+    pieces = []
+    while sum(len(p) for p in pieces) < length:
+        r = rng.random()
+        if r < 0.1:
+            pieces.append(
+                " ".join(rng.choices("あいうえお漢字々", k=rng.randint(2, 12)))
+            )
+        elif r < 0.15:
+            pieces.append("".join(rng.choices(".．・ー−~=", k=rng.randint(2, 6))))
+        elif r < 0.5:
+            pieces.append(
+                synthetic_words(rng, rng.randint(1, 8), cjk=rng.random() < 0.5)
+            )
+        else:
+            pieces.append(rng.choice(OCR_PIECES))
+    return "".join(pieces)
+
+
+def bench_clean_ocr(args):
+    """
+    Compare OCR text cleanup with the former one: output and time
+    benchmark.py clean_ocr [number of pages]
+    """
+    n_pages = int(args[0]) if args else 5000
+    rng = random.Random(0)
+    pages = OCR_CASES + [synthetic_ocr_page(rng) for _ in range(n_pages)]
+    n_pages = len(pages)
+
+    start = time.perf_counter()
+    expected = [clean_ocr_text_former(p) for p in pages]
+    former = time.perf_counter() - start
+    start = time.perf_counter()
+    single = [clean_ocr_text(p) for p in pages]
+    current = time.perf_counter() - start
+    start = time.perf_counter()
+    batch = clean_ocr_pages(pages)
+    batched = time.perf_counter() - start
+
+    mismatches = [
+        i for i, (e, s, b) in enumerate(zip(expected, single, batch)) if not e == s == b
+    ]
+    print(f"{n_pages} pages, {len(mismatches)} differ from the former output")
+    for i in mismatches[:3]:
+        print(repr(pages[i][:200]), repr(expected[i][:200]), repr(single[i][:200]))
+    print(f"{'':<16}{'ms/page':>10}")
+    for name, elapsed in (("former", former), ("page", current), ("batch", batched)):
+        print(f"{name:<16}{elapsed / n_pages * 1000:>10.3f}")
+    if mismatches:
+        sys.exit(1)
+    return {
+        "clean_ocr.page_ms": current / n_pages * 1000,
+        "clean_ocr.batch_ms": batched / n_pages * 1000,
+    }
+
+
+# ---- START-UP ---- #
+# Seconds allowed for importing each module (a gunicorn worker, the CLI)
+IMPORT_BUDGET = {"server": 0.8, "tools": 0.5, "fmfm_util": 0.5}
+# Must not be imported until a file needs them
+LAZY_MODULES = ("poppler", "bs4", "markdown", "requests", "PIL.ImageFont")
+
+
+def source_copy(root):
+    """Copy of the modules and the DB schema, whose library is under root"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    os.makedirs(os.path.join(root, "data"))
+    for name in os.listdir(here):
+        if name.endswith(".py"):
+            shutil.copy(os.path.join(here, name), root)
+    shutil.copy(SCHEMA_PATH, os.path.join(root, "data"))
+    return root
+
+
+def import_time(module, source, repeat=5):
+    """
+    Median seconds of importing module in a fresh interpreter
+    source: folder of the modules (a copy, since the server makes its DB)
+    """
+    code = (
+        "import sys, time; start = time.perf_counter(); "
+        f"import {module}; print(time.perf_counter() - start); "
+        f"print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+    )
+    timings, loaded = [], ""
+    for i in range(repeat + 1):
+        output = subprocess.run(
+            [sys.executable, "-c", code],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=source,
+        ).stdout.splitlines()
+        if i > 0:  # The first run compiles the copy
+            timings.append(float(output[0]))
+        loaded = output[1] if len(output) > 1 else ""
+    return statistics.median(timings), loaded
+
+
+def bench_import_time(args):
+    """
+    Import time of the modules, and heavy libraries imported too early
+    benchmark.py import_time [module ...]
+    """
+    modules = args or list(IMPORT_BUDGET)
+    ok = True
+    results = {}
+    print(f"{'module':<12}{'import (ms)':>12}{'budget (ms)':>13}  eagerly loaded")
+    with tempfile.TemporaryDirectory() as root:
+        source = source_copy(root)
+        timings = {module: import_time(module, source) for module in modules}
+    for module, (seconds, loaded) in timings.items():
+        budget = IMPORT_BUDGET.get(module, 1.0)
+        print(f"{module:<12}{seconds * 1000:>12.0f}{budget * 1000:>13.0f}  {loaded}")
+        ok = ok and seconds <= budget and not loaded
+        results[f"import.{module}_ms"] = seconds * 1000
+    if not ok:
+        print("Over the budget, or heavy libraries are imported at start-up.")
+        sys.exit(1)
+    return results
+
+
+# ---- BASELINE ---- #
+# Results are in ms or KiB; smaller differences are noise
+NOISE_FLOOR = 1.0
+
+
+def option_value(options, name, default, cast=str):
+    """Get value of --name=value style option"""
+    for o in options:
+        if o.startswith(f"--{name}="):
+            return cast(o.split("=", 1)[1])
+    return default
+
+
+def save_baseline(path, results):
+    """Store results with the environment"""
+    baseline = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "results": results,
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(baseline, f, indent=2)
+
+
+def compare_baseline(path, results, tolerance):
+    """Print the ratio to the baseline; True if nothing got slower or bigger"""
+    with open(path, encoding="utf-8") as f:
+        baseline = json.load(f)["results"]
+    ok = True
+    print(f"{'metric':<36}{'baseline':>12}{'now':>12}{'ratio':>8}")
+    for key, value in results.items():
+        if key not in baseline:
+            continue
+        ratio = value / baseline[key] if baseline[key] else math.inf
+        mark = ""
+        if abs(value - baseline[key]) < NOISE_FLOOR:
+            pass
+        elif ratio > 1 + tolerance:
+            mark, ok = "  worse", False
+        elif ratio < 1 - tolerance:
+            mark = "  better"
+        print(f"{key:<36}{baseline[key]:>12.2f}{value:>12.2f}{ratio:>8.2f}{mark}")
+    return ok
+
+
+# ---- MAIN ---- #
+functions = {
+    "ingest": bench_ingest,
+    "render": bench_render,
+    "search": bench_search,
+    "all": bench_all,
+    "epub_chunking": bench_epub_chunking,
+    "clean_ocr": bench_clean_ocr,
+    "import_time": bench_import_time,
+}
+
+if __name__ == "__main__":
+    try:
+        function = sys.argv[1]
+        options = [a for a in sys.argv[2:] if a.startswith("--")]
+        results = functions[function]([a for a in sys.argv[2:] if a not in options])
+
+        if results and option_value(options, "save", None):
+            save_baseline(option_value(options, "save", None), results)
+        if results and option_value(options, "compare", None):
+            tolerance = option_value(options, "tolerance", 0.2, cast=float)
+            if not compare_baseline(
+                option_value(options, "compare", None), results, tolerance
+            ):
+                sys.exit(1)
+    except IndexError:
+        print(f'Please specify benchmark: {" or ".join(functions.keys())}')
+    except KeyError:
+        print(
+            f'{function} is not supported. {" or ".join(functions.keys())} are supported benchmarks.'
+        )
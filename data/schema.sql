@@ -14,3 +14,4 @@ create table "books" (
     "modified_date"   TEXT
 );
 create virtual table fts using fts5(number, page, ngram);
+create virtual table meta_fts using fts5(title, tags);
@@ -0,0 +1,114 @@
+#!python3
+
+"""
+SQLite connections kept per worker
+Read-only connections are reused by requests, one at a time each, and all
+the writes of the worker go through one connection, serialized by a lock.
+"""
+
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from urllib.parse import quote
+
+import metrics
+from settings import (
+    DATABASE_PATH,
+    DB_READERS,
+    DB_CACHE_KIB,
+    DB_MMAP_SIZE,
+    DB_STATEMENT_CACHE,
+    DB_BUSY_TIMEOUT,
+    DB_WAL,
+)
+
+
+def connect(path=DATABASE_PATH, readonly=False):
+    """Tuned connection (shared between threads, one user at a time)"""
+    if readonly:
+        target, uri = f"file:{quote(path)}?mode=ro", True
+    else:
+        target, uri = path, False
+    database = sqlite3.connect(
+        target,
+        uri=uri,
+        timeout=DB_BUSY_TIMEOUT,
+        cached_statements=DB_STATEMENT_CACHE,
+        check_same_thread=False,
+        factory=metrics.TimedConnection,
+    )
+    database.row_factory = sqlite3.Row
+    database.execute(f"pragma cache_size = -{DB_CACHE_KIB}")
+    database.execute(f"pragma mmap_size = {DB_MMAP_SIZE}")
+    if DB_WAL and not readonly:
+        database.execute("pragma journal_mode = wal")
+    return database
+
+
+class ConnectionPool:
+    """Read-only connections and the writer of a worker"""
+
+    def __init__(self, path=DATABASE_PATH, size=DB_READERS):
+        self.path = path
+        self.size = size
+        self.inherited = []  # Connections of the parent process (not to be used)
+        self.reset()
+        os.register_at_fork(after_in_child=self.forked)
+
+    def reset(self):
+        """No connections yet"""
+        self.idle = queue.LifoQueue()  # Most recently used first (warm cache)
+        self.created = 0
+        self.lock = threading.Lock()
+        self.writer = None
+        self.writer_lock = threading.Lock()
+
+    def forked(self):
+        """Connections must not cross fork; kept (not closed) and left unused"""
+        self.inherited.append((self.idle, self.writer))
+        self.reset()
+
+    def acquire(self):
+        """Read-only connection (waits if all are in use)"""
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.created < self.size:
+                self.created += 1
+                return connect(self.path, readonly=True)
+        return self.idle.get()
+
+    def release(self, database):
+        """Return the read-only connection"""
+        if database.in_transaction:
+            database.rollback()
+        self.idle.put(database)
+
+    def acquire_writer(self):
+        """The writer connection (waits for the other writes of this worker)"""
+        self.writer_lock.acquire()
+        if self.writer is None:
+            self.writer = connect(self.path)
+        return self.writer
+
+    def release_writer(self):
+        """Return the writer; uncommitted changes are rolled back"""
+        if self.writer.in_transaction:
+            self.writer.rollback()
+        self.writer_lock.release()
+
+    @contextmanager
+    def reader(self):
+        """with pool.reader() as database: ..."""
+        database = self.acquire()
+        try:
+            yield database
+        finally:
+            self.release(database)
+
+
+pool = ConnectionPool()
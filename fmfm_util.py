@@ -5,10 +5,17 @@ import os
 import sys
 import shutil
 import glob
-from functools import partial
+import json
+import time
+from functools import partial, cache
+from multiprocessing import Pool
 
+from db_pool import connect
+import profiling
 from settings import *
-from tools import register_file, refresh_entry, remove_entry
+from tools import init_db, register_file, refresh_entry, remove_entry
+from tools import extract_entry, store_entry, make_thumbnails, load_pdf_cached
+from tools import edit_books, query_cleaner, search_books, EDIT_FLAGS
 
 # ---- SETTINGS ---- #
 database_path = "data/data.db"
@@ -16,13 +23,11 @@ inbox = "inbox"
 
 
 # ---- COMMON ---- #
+@cache
 def get_db():
-    DB = sqlite3.connect(DATABASE_PATH)
-    DB.row_factory = sqlite3.Row
-    return DB
-
-
-DB = get_db()
+    """Connection opened when a command first needs it"""
+    init_db()  # A DB made by older versions is upgraded as the server does
+    return connect(DATABASE_PATH)
 
 
 # ---- FUNCTIONS ---- #
@@ -38,7 +43,7 @@ def importer(dummy):
         print()
         print(f"Process for {g}")
         try:
-            new_number = register_file(g, database=DB)
+            new_number = register_file(g, database=get_db())
         except OSError as e:
             print(str(e))
             print("Check if the DB is (not) used by other user.")
@@ -56,8 +61,9 @@ def importer(dummy):
             break
 
         refresh_entry(
-            new_number, DB, extract_title=True
+            new_number, get_db(), extract_title=True
         )  # At first title is extracted.
+        load_pdf_cached.cache_clear()  # Parsed PDF is not used again
 
         print(f"{g} moved into _finished folder.")
         os.makedirs(f"{inbox}/_finished", exist_ok=True)
@@ -79,7 +85,7 @@ def remover(book_ids):
     for n in book_ids:
         print(f"Removing number {n}")
         try:
-            remove_entry(int(n), DB)
+            remove_entry(int(n), get_db())
         except IndexError:
             print(f"Err: Number {n} is not found in the database.")
         except Exception as e:
@@ -90,20 +96,237 @@ def remover(book_ids):
 
 # ---- METADATA UPDATER ---- #
 def updater(book_ids, extract_title=False):
+    if "--all" in book_ids:
+        return reindexer(book_ids, extract_title=extract_title)
+
     print("specify book ID to be update metadata")
     print("script.py update 1 2 3 4")
+    print("script.py update --profile 1 2 3 4 (profiles saved into data/profiles)")
+    print(
+        "script.py update --all [--resume] [--workers=N] [--batch=N] [--throttle=SEC]"
+    )
     if extract_title:
         print("The title of book is replaced using the book's metadata.")
 
-    for n in book_ids:
+    forced = "--profile" in book_ids
+    for n in [b for b in book_ids if not b.startswith("--")]:
         print(f"Updating number {n}")
         try:
-            refresh_entry(int(n), DB, extract_title=extract_title)
+            with profiling.profiled(f"refresh_{n}", forced=forced):
+                refresh_entry(int(n), get_db(), extract_title=extract_title)
         except IndexError:
             print(f"Err: Number {n} is not found in the database.")
         except Exception as e:
             print(f"Err: Unknown Error! {e}")
+        load_pdf_cached.cache_clear()  # Parsed PDF is not used again
+
+    print("Finished!")
+
+
+# ---- LIBRARY-WIDE REINDEXER ---- #
+def option_value(options, name, default, cast=int):
+    """Get value of --name=value style option"""
+    for o in options:
+        if o.startswith(f"--{name}="):
+            return cast(o.split("=", 1)[1])
+    return default
+
+
+def read_checkpoint():
+    """Last book number committed by the previous reindexing"""
+    try:
+        with open(REINDEX_CHECKPOINT_PATH, encoding="utf-8") as f:
+            return json.load(f)["last_number"]
+    except (FileNotFoundError, KeyError, ValueError):
+        return 0
+
+
+def write_checkpoint(last_number):
+    """Record the last committed book number"""
+    tmp_path = REINDEX_CHECKPOINT_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"last_number": last_number}, f)
+    os.replace(tmp_path, REINDEX_CHECKPOINT_PATH)
+
+
+def lower_priority(niceness):
+    """Pool initializer: yield CPU to the live server"""
+    os.nice(niceness)
+
+
+def extract_worker(args):
+    """Run extract_entry in a worker; errors are returned, not raised"""
+    number, filetype, extract_title = args
+    try:
+        extracted = extract_entry(number, filetype, extract_title=extract_title)
+        # Generated rows must be materialized to be sent back
+        extracted["index_data"] = tuple(extracted["index_data"])
+        return number, extracted
+    except Exception as e:
+        return number, e
+    finally:
+        load_pdf_cached.cache_clear()  # Parsed PDF is not used again
+
+
+def reindexer(options, extract_title=False):
+    """Rebuild thumbnails and text index of all the books in batches"""
+    resume = "--resume" in options
+    workers = option_value(options, "workers", REINDEX_WORKERS)
+    batch_size = option_value(options, "batch", REINDEX_BATCH_SIZE)
+    throttle = option_value(options, "throttle", 0.0, cast=float)
+
+    last_number = read_checkpoint() if resume else 0
+    if last_number > 0:
+        print(f"Resuming after number {last_number}")
+
+    # Throttled: lower priority of workers and sleep between batches
+    initializer, initargs = None, ()
+    if throttle > 0:
+        initializer, initargs = lower_priority, (REINDEX_NICE,)
+
+    cursor = get_db().cursor()
+    with Pool(workers, initializer=initializer, initargs=initargs) as pool:
+        while True:
+            cursor.execute(
+                "select * from books where number > ? order by number limit ?",
+                (last_number, batch_size),
+            )
+            entries = {e["number"]: e for e in cursor.fetchall()}
+            if not entries:
+                break
 
+            # Extraction runs in parallel
+            jobs = [(n, e["filetype"], extract_title) for n, e in entries.items()]
+            results = dict(pool.imap_unordered(extract_worker, jobs))
+
+            for n, r in results.items():
+                if isinstance(r, Exception):
+                    print(f"Err: Number {n} failed: {r}")
+            extracted = {n: r for n, r in results.items() if isinstance(r, dict)}
+
+            # One transaction per batch; old FTS rows are removed at once
+            # since deleting from fts scans the whole table.
+            try:
+                renewed = [n for n, r in extracted.items() if r["index_data"]]
+                if renewed:
+                    placeholder = ",".join("?" * len(renewed))
+                    cursor.execute(
+                        f"delete from fts where number in ({placeholder})", renewed
+                    )
+                for n, r in extracted.items():
+                    store_entry(entries[n], r, cursor, clear_index=False)
+                cursor.connection.commit()
+            except sqlite3.Error as e:
+                cursor.connection.rollback()
+                print("DATABASE FAILURE", e)
+                print("Run again with --resume to continue.")
+                return
+
+            last_number = max(entries)
+            write_checkpoint(last_number)
+            print(f"Updated {len(extracted)}/{len(entries)} books up to {last_number}")
+
+            if throttle > 0:
+                time.sleep(throttle)
+
+    # Whole library has been done
+    if os.path.exists(REINDEX_CHECKPOINT_PATH):
+        os.remove(REINDEX_CHECKPOINT_PATH)
+    print("Finished!")
+
+
+# ---- THUMBNAIL GENERATOR ---- #
+def thumbnail_worker(args):
+    """Run make_thumbnails in a worker; errors are returned, not raised"""
+    number, filetype = args
+    try:
+        make_thumbnails(number, filetype)
+        return number, None
+    except Exception as e:
+        return number, e
+    finally:
+        load_pdf_cached.cache_clear()  # Parsed PDF is not used again
+
+
+def thumbnailer(book_ids):
+    print("specify book ID to regenerate thumbnails")
+    print("script.py thumbnail 1 2 3 4")
+    print("script.py thumbnail --all [--workers=N]")
+
+    cursor = get_db().cursor()
+    if "--all" in book_ids:
+        cursor.execute("select number, filetype from books order by number")
+    else:
+        numbers = [int(n) for n in book_ids if not n.startswith("--")]
+        placeholder = ",".join("?" * len(numbers))
+        cursor.execute(
+            f"select number, filetype from books where number in ({placeholder})",
+            numbers,
+        )
+    jobs = [(e["number"], e["filetype"]) for e in cursor.fetchall()]
+
+    workers = option_value(book_ids, "workers", REINDEX_WORKERS)
+    with Pool(workers) as pool:
+        for n, e in pool.imap_unordered(thumbnail_worker, jobs):
+            if e is None:
+                print(f"Thumbnails of number {n} generated")
+            else:
+                print(f"Err: Number {n} failed: {e}")
+
+    print("Finished!")
+
+
+# ---- BATCH EDITOR ---- #
+def editor(options):
+    print("specify changes and books to be edited at once")
+    print("script.py edit --add=tag1,tag2 --remove=tag3 --hide=1 1 2 3 4")
+    print("script.py edit --add=tag1 --tag=manga (books with the tag)")
+    print("script.py edit --spread=0 --query=text (books found by search)")
+    print("script.py edit --r2l=1 --all")
+
+    cursor = get_db().cursor()
+    tag = option_value(options, "tag", "", cast=str)
+    query = option_value(options, "query", "", cast=str)
+    if "--all" in options:
+        cursor.execute("select number from books")
+        numbers = [r["number"] for r in cursor.fetchall()]
+    elif tag:
+        cursor.execute(
+            "select number from books where ' ' || tags || ' ' like '% ' || ? || ' %'",
+            (tag,),
+        )
+        numbers = [r["number"] for r in cursor.fetchall()]
+    elif query:
+        numbers = list(search_books(cursor, query_cleaner(query))[0])
+    else:
+        numbers = [int(n) for n in options if not n.startswith("--")]
+
+    add_tags = option_value(options, "add", "", cast=str).replace(",", " ").split()
+    remove_tags = (
+        option_value(options, "remove", "", cast=str).replace(",", " ").split()
+    )
+    flags = {}
+    for flag in EDIT_FLAGS:
+        value = option_value(options, flag, None)
+        if value is not None:
+            flags[flag] = value
+
+    # All the books in one transaction
+    try:
+        edited = edit_books(
+            numbers,
+            cursor,
+            add_tags=add_tags,
+            remove_tags=remove_tags,
+            flags=flags,
+        )
+        cursor.connection.commit()
+    except sqlite3.Error as e:
+        cursor.connection.rollback()
+        print("DATABASE FAILURE", e)
+        return
+
+    print(f"Edited {edited} books")
     print("Finished!")
 
 
@@ -113,14 +336,17 @@ functions = {
     "remove": remover,
     "update": updater,
     "update_title": partial(updater, extract_title=True),
+    "thumbnail": thumbnailer,
+    "edit": editor,
 }
 
-try:
-    function = sys.argv[1]
-    functions[function](sys.argv[2:])
-except IndexError:
-    print(f'Please specify command: {" or ".join(functions.keys())}')
-except KeyError:
-    print(
-        f'{function} is not supported. {" or ".join(functions.keys())} are supported commands.'
-    )
+if __name__ == "__main__":
+    try:
+        function = sys.argv[1]
+        functions[function](sys.argv[2:])
+    except IndexError:
+        print(f'Please specify command: {" or ".join(functions.keys())}')
+    except KeyError:
+        print(
+            f'{function} is not supported. {" or ".join(functions.keys())} are supported commands.'
+        )
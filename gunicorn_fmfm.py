@@ -7,3 +7,7 @@ proc_name = "FMFM"
 workers = 2
 threads = 1
 timeout = 6000
+
+# Async serving mode (asgi.py): FMFM_SERVING=async gunicorn asgi:app -c gunicorn_fmfm.py
+if os.getenv("FMFM_SERVING") == "async":
+    worker_class = "uvicorn_worker.UvicornWorker"
@@ -0,0 +1,297 @@
+#!python3
+
+"""
+Metrics for FMFM (Prometheus text format)
+Each process counts in memory and writes its values into METRICS_DIR from
+time to time; /metrics sums up the files of all the processes.
+"""
+
+import os
+import json
+import fcntl
+import time
+import sqlite3
+import functools
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from settings import METRICS_ENABLED, METRICS_DIR, METRICS_FLUSH_INTERVAL
+
+# Upper bounds of histogram buckets (seconds)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# (name, labels) -> value
+counters = {}
+gauges = {}
+# (name, labels) -> [bucket counts..., sum, count]
+histograms = {}
+
+lock = threading.Lock()
+last_flush = 0.0
+
+# Values of exited processes, summed up (in METRICS_DIR)
+EXITED_FILE = "exited.json"
+
+
+def key_of(name, labels):
+    """Dictionary key of a metric"""
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """Add to a counter"""
+    key = key_of(name, labels)
+    with lock:
+        counters[key] = counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    """Set a gauge"""
+    gauges[key_of(name, labels)] = value
+
+
+def observe(name, seconds, **labels):
+    """Add an observation to a histogram"""
+    key = key_of(name, labels)
+    with lock:
+        hist = histograms.get(key)
+        if hist is None:
+            hist = histograms[key] = [0] * (len(BUCKETS) + 2)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                hist[i] += 1
+                break
+        hist[-2] += seconds
+        hist[-1] += 1
+
+
+@contextmanager
+def timer(name, **labels):
+    """Measure the time of the block into a histogram"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def timed(stage):
+    """Decorator: time the function as a stage"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer("fmfm_stage_seconds", stage=stage):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def cache_result(cache, hit):
+    """Count a cache lookup"""
+    inc("fmfm_cache_requests_total", cache=cache, result="hit" if hit else "miss")
+
+
+def reset():
+    """Start from zero (forked processes must not count the parent's values)"""
+    global lock, last_flush
+    lock = threading.Lock()
+    last_flush = 0.0
+    counters.clear()
+    gauges.clear()
+    histograms.clear()
+
+
+os.register_at_fork(after_in_child=reset)
+
+
+# DB connection counting queries
+# List to collect (statement, seconds) while profiling (see profiling.py)
+sql_trace = ContextVar("sql_trace", default=None)
+
+
+def timed_statement(method, sql, args):
+    """Run a statement, measured"""
+    start = time.perf_counter()
+    try:
+        return method(sql, *args)
+    finally:
+        elapsed = time.perf_counter() - start
+        op = (sql.split(None, 1) or ["?"])[0].lower()
+        observe("fmfm_db_query_seconds", elapsed, op=op)
+        trace = sql_trace.get()
+        if trace is not None:
+            trace.append((sql, elapsed))
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor measuring each statement"""
+
+    def execute(self, sql, *args):
+        return timed_statement(super().execute, sql, args)
+
+    def executemany(self, sql, *args):
+        return timed_statement(super().executemany, sql, args)
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose cursors are TimedCursor"""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, *args):
+        return self.cursor().execute(sql, *args)
+
+
+# Sharing between processes
+def flush(force=False):
+    """Write the values of this process, at most once per interval"""
+    global last_flush
+    now = time.monotonic()
+    if not METRICS_ENABLED or (not force and now - last_flush < METRICS_FLUSH_INTERVAL):
+        return
+    last_flush = now
+
+    with lock:
+        values = {
+            "counters": [[n, dict(l), v] for (n, l), v in counters.items()],
+            "gauges": [[n, dict(l), v] for (n, l), v in gauges.items()],
+            "histograms": [[n, dict(l), list(v)] for (n, l), v in histograms.items()],
+        }
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(values, f)
+    os.replace(path + ".tmp", path)
+
+
+def run_and_flush(func, *args):
+    """func(*args) in a worker process, then write its values"""
+    try:
+        return func(*args)
+    finally:
+        flush(force=True)
+
+
+def is_alive(pid):
+    """True if the process exists"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def format_labels(labels, **extra):
+    """Labels in exposition format"""
+    labels = {**labels, **extra}
+    if not labels:
+        return ""
+    escaped = (
+        str(v).replace("\\", "\\\\").replace('"', '\\"') for v in labels.values()
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + "}"
+
+
+def add_values(totals, values, gauges=True):
+    """Add values of a process file into totals (counters, gauges, histograms)"""
+    total_counters, total_gauges, total_histograms = totals
+    for name, labels, value in values["counters"]:
+        key = key_of(name, labels)
+        total_counters[key] = total_counters.get(key, 0) + value
+    if gauges:
+        for name, labels, value in values["gauges"]:
+            key = key_of(name, labels)
+            total_gauges[key] = total_gauges.get(key, 0) + value
+    for name, labels, value in values["histograms"]:
+        key = key_of(name, labels)
+        total = total_histograms.setdefault(key, [0] * len(value))
+        total_histograms[key] = [a + b for a, b in zip(total, value)]
+
+
+def read_values(path):
+    """Values in a process file"""
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def retire(path):
+    """
+    Fold the file of an exited process into EXITED_FILE and remove it.
+    Counters and histograms are kept; gauges are outdated.
+    """
+    claimed = path + ".retiring"
+    try:
+        os.rename(path, claimed)  # Only one process wins
+    except FileNotFoundError:
+        return
+
+    exited_path = os.path.join(METRICS_DIR, EXITED_FILE)
+    with open(exited_path + ".lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        totals = ({}, {}, {})
+        for source in (exited_path, claimed):
+            try:
+                add_values(totals, read_values(source), gauges=False)
+            except (OSError, ValueError):
+                continue
+        values = {
+            "counters": [[n, dict(l), v] for (n, l), v in totals[0].items()],
+            "gauges": [],
+            "histograms": [[n, dict(l), v] for (n, l), v in totals[2].items()],
+        }
+        with open(exited_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(values, f)
+        os.replace(exited_path + ".tmp", exited_path)
+    os.remove(claimed)
+
+
+def exposition():
+    """Sum of all the processes in Prometheus text format"""
+    flush(force=True)
+    for entry in os.scandir(METRICS_DIR):
+        pid = entry.name.split(".")[0]
+        if entry.name == f"{pid}.json" and pid.isdigit() and not is_alive(int(pid)):
+            retire(entry.path)
+
+    totals = ({}, {}, {})
+    for entry in os.scandir(METRICS_DIR):
+        if not entry.name.endswith(".json"):
+            continue
+        try:
+            add_values(totals, read_values(entry.path))
+        except (OSError, ValueError):
+            continue
+    total_counters, total_gauges, total_histograms = totals
+
+    lines = []
+    for kind, metrics in (("counter", total_counters), ("gauge", total_gauges)):
+        for name in sorted({n for n, _ in metrics}):
+            lines.append(f"# TYPE {name} {kind}")
+            for (n, labels), value in sorted(metrics.items()):
+                if n == name:
+                    lines.append(f"{name}{format_labels(dict(labels))} {value}")
+
+    for name in sorted({n for n, _ in total_histograms}):
+        lines.append(f"# TYPE {name} histogram")
+        for (n, labels), hist in sorted(total_histograms.items()):
+            if n != name:
+                continue
+            labels = dict(labels)
+            cumulative = 0
+            for bound, count in zip(BUCKETS, hist):
+                cumulative += count
+                lines.append(
+                    f"{name}_bucket{format_labels(labels, le=bound)} {cumulative}"
+                )
+            lines.append(f'{name}_bucket{format_labels(labels, le="+Inf")} {hist[-1]}')
+            lines.append(f"{name}_sum{format_labels(labels)} {hist[-2]}")
+            lines.append(f"{name}_count{format_labels(labels)} {hist[-1]}")
+
+    return "\n".join(lines) + "\n"
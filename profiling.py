@@ -0,0 +1,96 @@
+#!python3
+
+"""
+Profiling of slow requests (opt-in, PROFILE_ENABLED in settings.py)
+A profile has cProfile stats (.prof, for pstats or snakeviz) and a summary
+(.txt) with the SQL statements and their times.
+"""
+
+import io
+import os
+import time
+import random
+import pstats
+import cProfile
+from contextlib import contextmanager
+
+import metrics
+from tools import prune_cache
+from settings import (
+    PROFILE_ENABLED,
+    PROFILE_SAMPLE_RATE,
+    PROFILE_SLOW_SECONDS,
+    PROFILE_DIR,
+    PROFILE_KEEP,
+)
+
+
+def sampled(forced=False):
+    """True if this request (or task) is profiled"""
+    return forced or (PROFILE_ENABLED and random.random() < PROFILE_SAMPLE_RATE)
+
+
+class Profile:
+    """cProfile and SQL statements of a request (or a task)"""
+
+    def __init__(self):
+        self.sql = []
+        self.token = metrics.sql_trace.set(self.sql)
+        self.profiler = cProfile.Profile()
+        try:
+            self.profiler.enable()
+        except ValueError:
+            self.profiler = None  # Another profiler is running (Python 3.12+)
+        self.started = time.perf_counter()
+
+    def stop(self):
+        """Stop profiling; returns seconds"""
+        elapsed = time.perf_counter() - self.started
+        if self.profiler is not None:
+            self.profiler.disable()
+        metrics.sql_trace.reset(self.token)
+        return elapsed
+
+    def save(self, name, elapsed, info=None):
+        """Write the profile into PROFILE_DIR, dropping old ones"""
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        base = os.path.join(
+            PROFILE_DIR, f"{stamp}_{name}_{elapsed * 1000:.0f}ms_{os.getpid()}"
+        )
+
+        summary = io.StringIO()
+        summary.write(f"{name}: {elapsed:.3f} s\n")
+        for key, value in (info or {}).items():
+            summary.write(f"{key}: {value}\n")
+
+        sql_seconds = sum(t for _, t in self.sql)
+        summary.write(f"\n---- SQL: {len(self.sql)} statements, {sql_seconds:.3f} s\n")
+        for sql, seconds in self.sql:
+            summary.write(f"{seconds * 1000:9.2f} ms  {' '.join(sql.split())}\n")
+
+        if self.profiler is not None:
+            self.profiler.dump_stats(base + ".prof")
+            summary.write("\n---- Profile (top 30, cumulative)\n")
+            stats = pstats.Stats(self.profiler, stream=summary)
+            stats.sort_stats("cumulative").print_stats(30)
+
+        with open(base + ".txt", "w", encoding="utf-8") as f:
+            f.write(summary.getvalue())
+        prune_cache(PROFILE_DIR, PROFILE_KEEP * 2)  # .prof and .txt
+
+
+@contextmanager
+def profiled(name, info=None, forced=False):
+    """Profile the block (if sampled), saved if slow or forced"""
+    if not sampled(forced):
+        yield
+        return
+
+    profile = Profile()
+    try:
+        yield
+    finally:
+        elapsed = profile.stop()
+        if forced or elapsed >= PROFILE_SLOW_SECONDS:
+            profile.save(name, elapsed, info)
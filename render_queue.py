@@ -0,0 +1,95 @@
+#!python3
+
+"""
+Render queue for async serving mode
+A bounded priority queue in front of the render processes: the page being
+viewed goes before preloads, abandoned or expired jobs are dropped, and
+submitting to a full queue fails instead of piling up work.
+"""
+
+import asyncio
+import heapq
+import itertools
+
+
+class Overloaded(Exception):
+    """The queue is full of jobs of the same or higher priority"""
+
+
+class DeadlineExceeded(Exception):
+    """The job waited longer than its deadline"""
+
+
+class RenderQueue:
+    """Priority queue of jobs run in an executor (lower priority value first)"""
+
+    def __init__(self, executor, concurrency, maxsize):
+        self.executor = executor
+        self.concurrency = concurrency
+        self.maxsize = maxsize
+        self.jobs = []  # heap of (priority, seq, deadline, future, func, args)
+        self.seq = itertools.count()
+        self.loop = None
+        self.wakeup = None
+        self.consumers = []
+
+    def __len__(self):
+        return len(self.jobs)
+
+    async def submit(self, func, *args, priority=0, timeout=30.0):
+        """Run func(*args) in the executor and wait for the result"""
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            # Consumers live in the event loop (first use, or loop replaced)
+            self.loop = loop
+            self.jobs = []
+            self.wakeup = asyncio.Condition()
+            self.consumers = [
+                asyncio.create_task(self.consume()) for _ in range(self.concurrency)
+            ]
+
+        # Full: forget abandoned jobs, then drop the least important job,
+        # if less important than this one
+        if len(self.jobs) >= self.maxsize:
+            self.jobs = [job for job in self.jobs if not job[3].done()]
+            heapq.heapify(self.jobs)
+        if len(self.jobs) >= self.maxsize:
+            worst = max(self.jobs)
+            if worst[0] <= priority:
+                raise Overloaded
+            self.jobs.remove(worst)
+            heapq.heapify(self.jobs)
+            if not worst[3].done():
+                worst[3].set_exception(Overloaded())
+
+        future = loop.create_future()
+        job = (priority, next(self.seq), loop.time() + timeout, future, func, args)
+        heapq.heappush(self.jobs, job)
+        async with self.wakeup:
+            self.wakeup.notify()
+
+        # Cancelling the waiting task also cancels the future (abandoned job)
+        return await future
+
+    async def consume(self):
+        """Take jobs one by one and run them"""
+        loop = asyncio.get_running_loop()
+        while True:
+            async with self.wakeup:
+                await self.wakeup.wait_for(lambda: self.jobs)
+                _, _, deadline, future, func, args = heapq.heappop(self.jobs)
+
+            if future.done():
+                continue  # Abandoned or dropped
+            if loop.time() > deadline:
+                future.set_exception(DeadlineExceeded())
+                continue
+
+            try:
+                result = await loop.run_in_executor(self.executor, func, *args)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            if not future.done():
+                future.set_result(result)
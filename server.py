@@ -6,44 +6,74 @@ Main server module for routing and rendering
 
 import os
 import io
-import re
 import random
 import sqlite3
 
+import time
 import socket
-import requests
+from collections import Counter
 
 from flask import Flask, render_template, request, redirect, url_for, make_response
 from flask import abort, flash, session, send_file, send_from_directory
 from flask import g
 from flask_paginate import Pagination, get_page_parameter
+from PIL import Image
 
 from werkzeug.datastructures import FileStorage
 
-from tools import init_db, sqlresult_to_an_entry
+import metrics
+from db_pool import pool
+import profiling
+
+from tools import init_db, sqlresult_to_an_entry, index_metadata
+from tools import book_column_types, edit_books, EDIT_FLAGS
 from tools import (
-    resize_keep_aspect,
-    zipcat,
-    pdf2img,
+    BOOK_FILE_ERRORS,
+    book_file,
+    select_books,
+    precompressed_variant,
+    render_page,
     register_file,
     refresh_entry,
     remove_entry,
+    thumbnail_path,
+    make_thumbnails,
+    thumbsheet_key,
+    thumbsheet_path,
+    make_thumbsheet,
+    manifest_path,
+    make_manifest,
+    tile_levels,
+    tile_page_size,
+    render_tile,
+    tile_path,
 )
-from tools import n_gram, n_gram_to_txt, show_hit_text, md_ext
+from tools import n_gram_to_txt, show_hit_text, render_markdown
+from tools import query_cleaner, search_books
 from settings import (
     SECRET_KEY,
-    DATABASE_PATH,
     PER_PAGE_ENTRY,
     PER_PAGE_SEARCH,
     UPLOADDIR_PATH,
     THUMBDIR_PATH,
     ALLOWED_EXT_MIMETYPE,
-    PDF_IMG_DPI,
     IMG_MIMETYPES,
     IMG_SHRINK,
-    IMG_SHRINK_WIDTH,
-    IMG_SHRINK_HEIGHT,
     HIDE_KEYS,
+    THUMB_SIZES,
+    THUMBSHEET_CELL,
+    THUMBSHEET_COLUMNS,
+    THUMBSHEET_MAX,
+    RAW_DELIVERY,
+    X_ACCEL_PREFIX,
+    PRECOMPRESS_FILETYPES,
+    METRICS_ENABLED,
+    PROFILE_ENABLED,
+    PROFILE_HEADER,
+    PROFILE_SLOW_SECONDS,
+    SEARCH_EXCERPTS,
+    SEARCH_FACET_TAGS,
+    TILE_SIZE,
 )
 
 # sql3_db initialization
@@ -52,35 +82,96 @@ init_db()
 # Flask initialization
 app = Flask(__name__)
 app.secret_key = SECRET_KEY
-config = {"SESSION_COOKIE_HTTPONLY": True, "SESSION_COOKIE_SAMESITE": "Lax"}
+config = {
+    "SESSION_COOKIE_HTTPONLY": True,
+    "SESSION_COOKIE_SAMESITE": "Lax",
+    "USE_X_SENDFILE": RAW_DELIVERY == "x-sendfile",
+}
 app.config.from_mapping(config)
 
 # Hostname (just for showing)
 hostname = socket.gethostname()
 
 
-def get_db():
-    """Opening sql3_db"""
-    sql3_db = getattr(g, "_database", None)
-    if sql3_db is None:
-        sql3_db = g._database = sqlite3.connect(DATABASE_PATH)
-        sql3_db.row_factory = sqlite3.Row
+def get_db(write=None):
+    """
+    sql3_db of the request, from the pool of the worker
+    write: True for the writer, False for read-only (default: by HTTP method)
+    """
+    if write is None:
+        write = request.method not in ("GET", "HEAD")
+    if write:
+        sql3_db = g.get("_writer")
+        if sql3_db is None:
+            sql3_db = g._writer = pool.acquire_writer()
+    else:
+        sql3_db = g.get("_database")
+        if sql3_db is None:
+            sql3_db = g._database = pool.acquire()
     return sql3_db
 
 
 @app.teardown_appcontext
 def close_connection(e=None):
-    """Closing sql3_db"""
-    sql3_db = getattr(g, "_database", None)
+    """Returning sql3_db into the pool"""
+    sql3_db = g.pop("_database", None)
     if sql3_db is not None:
-        sql3_db.close()
+        pool.release(sql3_db)
+    if g.pop("_writer", None) is not None:
+        pool.release_writer()
+
+
+@app.before_request
+def start_timer():
+    """Start of request (for metrics and profiling)"""
+    g._started = time.perf_counter()
+    # The header works only if profiling is enabled
+    forced = PROFILE_ENABLED and PROFILE_HEADER in request.headers
+    if profiling.sampled(forced=forced):
+        g._profile = profiling.Profile()
+
+
+@app.after_request
+def count_request(response):
+    """Latency, status and bytes of request"""
+    route = request.endpoint or "unknown"
+    started = g.get("_started")
+    if started is not None:
+        metrics.observe(
+            "fmfm_request_seconds", time.perf_counter() - started, route=route
+        )
+    metrics.inc("fmfm_requests_total", route=route, status=response.status_code)
+    if response.content_length:
+        metrics.inc("fmfm_response_bytes_total", response.content_length, route=route)
+    metrics.flush()
+    g._status = response.status_code
+    return response
+
+
+@app.teardown_request
+def save_profile(e=None):
+    """Save the profile if slow (or asked by the header)"""
+    profile = g.pop("_profile", None)
+    if profile is None:
+        return
+    elapsed = profile.stop()
+    if PROFILE_HEADER in request.headers or elapsed >= PROFILE_SLOW_SECONDS:
+        info = {
+            "url": request.full_path,
+            "method": request.method,
+            "status": g.get("_status", 500),
+            "error": repr(e) if e else "",
+        }
+        profile.save(request.endpoint or "unknown", elapsed, info)
 
 
 @app.template_global()
 def modify_query(**new_values):
     """# to append queries with AND condition"""
     args = request.args.copy()
-    return args | new_values
+    for key, value in new_values.items():
+        args[key] = value  # Replaces, not adds
+    return args
 
 
 @app.template_global()
@@ -99,32 +190,41 @@ def flash_and_go(message, status, toward):
     return redirect(toward)
 
 
-def send_pil_image(
-    pil_img, imgtype=None, imgmode=None, quality=100, shrink=False, caching=True
-):
-    """PIL Image -> Image file"""
-    if shrink is True or imgtype is not None:  # REFACT consider splitting
-        imgtype = "jpeg"
-        quality = 90
-        imgmode = "RGB"
-
-        if (pil_img.width >= pil_img.height) and (pil_img.width > IMG_SHRINK_WIDTH):
-            pil_img = resize_keep_aspect(pil_img, width=IMG_SHRINK_WIDTH)
-        if (pil_img.height >= pil_img.width) and (pil_img.height > IMG_SHRINK_HEIGHT):
-            pil_img = resize_keep_aspect(pil_img, height=IMG_SHRINK_HEIGHT)
-
-    imgtype = imgtype.lower()
-    pil_img = pil_img.convert(imgmode)
-    img_io = io.BytesIO()
-    pil_img.save(img_io, imgtype, quality=quality)
-    img_io.seek(0)
-
-    response = make_response(send_file(img_io, mimetype=IMG_MIMETYPES[imgtype]))
+def send_image(data, imgtype, caching=True):
+    """Encoded image (bytes or list of chunks, sent as they are) -> Response"""
+    response = app.response_class(data)
+    if not isinstance(data, bytes):
+        response.content_length = sum(len(c) for c in data)
+    response.mimetype = IMG_MIMETYPES[imgtype]
     if caching:
         response.headers["Cache-Control"] = "max-age=3000"
     return response
 
 
+def thumbsheet_layout(rows):
+    """Sprite sheet URL and position (CSS px) of each book in the grid"""
+    rows = [r for r in rows if not r["hide"]][:THUMBSHEET_MAX]
+    if not rows:
+        return None
+
+    cell_w, cell_h = (v // 2 for v in THUMBSHEET_CELL)  # shown at half size
+    positions = {}
+    for i, r in enumerate(rows):
+        row, col = divmod(i, THUMBSHEET_COLUMNS)
+        positions[r["number"]] = (col * cell_w, row * cell_h)
+
+    return {
+        "url": url_for(
+            "thumbsheet",
+            ids=",".join(str(r["number"]) for r in rows),
+            v=thumbsheet_key((r["number"], r["md5"]) for r in rows),
+        ),
+        "pos": positions,
+        "cell": (cell_w, cell_h),
+        "width": cell_w * THUMBSHEET_COLUMNS,
+    }
+
+
 # Sorting method table
 sort_methods = {
     "title_asc": ("title", "asc"),
@@ -181,27 +281,52 @@ def index():
         "list.html",
         title=f"FMFM: Fast Minimal File Manager (at {hostname})",
         rows=data_in_page,
+        sheet=thumbsheet_layout(data_in_page),
         pagination=pagination,
         tag=tag,
-        sort_by=sort_by,
     )
 
 
-def query_cleaner(query):
-    """Cleanup messy query"""
-    query = query.replace("\u3000", " ")  # full-width space
-    query = re.sub(r" ([\&\+\(\)\*\\\#]) ", r"\1", query)  # Care for orphan symbols
+def search_filters(args, number=0):
+    """
+    SQL conditions on books from the request, and their parameters.
+    tag, filetype, date_from/date_to (registered, YYYY-MM-DD) and
+    hidden=1 (hidden books are left out unless searching in a book)
+    """
+    conditions, params = [], {}
+    if number > 0:
+        conditions.append("books.number = :number")
+        params["number"] = number
+    elif args.get("hidden", type=int, default=0) == 0:
+        conditions.append("coalesce(books.hide, 0) = 0")
+
+    if args.get("tag", ""):
+        # Whole space-separated tag, not a substring of another tag
+        conditions.append("' ' || books.tags || ' ' like '% ' || :tag || ' %'")
+        params["tag"] = args.get("tag")
+    if args.get("filetype", ""):
+        conditions.append("books.filetype = :filetype")
+        params["filetype"] = args.get("filetype")
+    if args.get("date_from", ""):
+        conditions.append("nullif(books.registered_date, '') >= date(:date_from)")
+        params["date_from"] = args.get("date_from")
+    if args.get("date_to", ""):
+        conditions.append(
+            "nullif(books.registered_date, '') < date(:date_to, '+1 day')"
+        )
+        params["date_to"] = args.get("date_to")
 
-    # (i) For western languages
-    query_quoted = " ".join([f'"{q}"' for q in query.split(" ")])
+    return " and ".join(conditions) or "1", params
 
-    # (ii) for languages without delimiter
-    ngram_ary = [f'"{n_gram(q)}"' if len(q) > 1 else q for q in query.split(" ")]
-    query_ngram = "(" + " ".join(ngram_ary) + ")"
 
-    # (iii) (i) and (ii) are merged
-    query_merged = query_quoted + " OR " + query_ngram
-    return query_merged
+def search_facets(hits):
+    """Number of hit books per filetype and per tag"""
+    filetypes = Counter(h["filetype"] for h in hits)
+    tags = Counter(t for h in hits for t in set((h["tags"] or "").split()))
+    return {
+        "filetype": filetypes.most_common(),
+        "tag": tags.most_common(SEARCH_FACET_TAGS),
+    }
 
 
 @app.route("/search")
@@ -211,7 +336,6 @@ def search():
     query = request.args.get("query", type=str, default="")
     number = request.args.get("number", type=int, default=0)
     tag = request.args.get("tag", type=str, default="")
-    sort_by = request.args.get("sort_by", type=str, default="title_asc")
 
     # No query no result
     if query == "":
@@ -226,84 +350,65 @@ def search():
             url_for("index", tag=tag),
         )
 
-    # Call SQL to run full-text search
-    if number > 0:
-        cursor.execute(
-            """
-            select * from fts where ngram match :textquery
-            and number = :number
-            order by bm25(fts) limit 500 
-            """,
-            {
-                "textquery": query_merged,
-                "number": number,
-            },
-        )
-    else:
+    # Filters are joined in the full-text search, so all the books are ranked
+    filters, params = search_filters(request.args, number)
+
+    hits, meta_hits = search_books(cursor, query_merged, filters, params, number)
+
+    # Books ranked by their best hit (bm25: smaller is better)
+    ranking = sorted(hits, key=lambda n: hits[n]["score"])
+    facets = search_facets(hits.values())
+
+    # Page position control
+    page = request.args.get(get_page_parameter(), type=int, default=1)
+    per_page = request.args.get("per_page", type=int, default=PER_PAGE_SEARCH)
+
+    # Paginate data
+    start_at = per_page * (page - 1)
+    end_at = per_page * (page)
+    numbers_in_page = ranking[start_at:end_at]
+    placeholder = ",".join("?" * len(numbers_in_page))
+
+    # Best pages of the books in this page
+    with metrics.timer("fmfm_stage_seconds", stage="search_excerpt"):
         cursor.execute(
-            """
-            select * from fts where ngram match :textquery
-            order by bm25(fts) limit 500 
+            f"""
+            select number, page, ngram from (
+                select number, page, ngram,
+                row_number() over (partition by number order by bm25(fts)) as rank
+                from fts where ngram match ? and number in ({placeholder})
+            ) where rank <= ? order by rank
             """,
-            {"textquery": query_merged},
+            [query_merged, *numbers_in_page, SEARCH_EXCERPTS],
         )
+        fts_result = cursor.fetchall()
 
     # Format results into book->page->Ngram
-    fts_result = cursor.fetchall()
-    fts_excerpt = {x: {} for x in [r["number"] for r in fts_result]}
+    data_in_page = {n: {} for n in numbers_in_page}
     for d in fts_result:
         d = dict(d)
         orig_txt = n_gram_to_txt(d["ngram"])
         excerpted = show_hit_text(orig_txt, query)
         if excerpted == "...":
             pass  # ToDo 何かがおかしいので一旦握りつぶさずにおく。
-        fts_excerpt[d["number"]].update({d["page"]: excerpted})
+        data_in_page[d["number"]].update({d["page"]: excerpted})
 
     # Get title of hits
-    numbers = ",".join([str(s) for s in fts_excerpt.keys()])
     cursor.execute(
-        f"select * from Books where number in ({numbers})",
+        f"select number, title, md5 from books where number in ({placeholder})",
+        numbers_in_page,
     )
-    title_results = cursor.fetchall()
-
-    if number == 0:
-        # Re-search sql3_db for title and get Book title from FTS search
-        cursor.execute(
-            "select * from Books where title like :title",
-            {
-                "title": f"%{query}%",  # ToDo: DANGER!
-            },
-        )
-        title_results += cursor.fetchall()
+    for num, title, md5 in cursor.fetchall():
+        data_in_page[num].update({"title": title, "md5": md5})
 
-    # Update full-text result with title result
-    for i in title_results:
-        entry = dict(i)
-        num, title = entry["number"], entry["title"]
-
-        # Insert title into result dict
-        if num in fts_excerpt.keys():
-            fts_excerpt[num].update({"title": title})
-        else:
-            fts_excerpt[num] = {"title": title}
-
-        # If title only matches
-        if query.lower() in title.lower():
-            fts_excerpt[num].update({0: "[Document Title matches]"})
-
-    # Page position control
-    page = request.args.get(get_page_parameter(), type=int, default=1)
-    per_page = request.args.get("per_page", type=int, default=PER_PAGE_SEARCH)
-
-    # Paginate data
-    start_at = per_page * (page - 1)
-    end_at = per_page * (page)
-    data_in_page = dict(list(fts_excerpt.items())[start_at:end_at])
+        # If title or tags match
+        if num in meta_hits:
+            data_in_page[num].update({0: "[Document Title or Tags match]"})
 
     # Split result into pages
     pagination = Pagination(
         page=page,
-        total=len(fts_excerpt),
+        total=len(ranking),
         per_page=per_page,
         css_framework="bootstrap5",
     )
@@ -312,10 +417,10 @@ def search():
         "search.html",
         title=f"Search result for {query}",
         excerpt_per_book=data_in_page,
+        facets=facets,
         pagination=pagination,
         query=query,
         tag=tag,
-        sort_by=sort_by,
     )
 
 
@@ -370,10 +475,11 @@ def show(number, start_from):
         file_real = os.path.join(app.config["UPLOAD_FOLDER"], filename)
         with open(file_real, encoding="utf-8") as fp:  # ToDo: encoding choice?
             text = fp.read()
+        html, _ = render_markdown(text)
         return render_template(
             "markdown.html",
             data=data,
-            markdown=md_ext(text),
+            markdown=html,
             prev_url=prev_url,
             query=query,
         )
@@ -396,19 +502,44 @@ def show(number, start_from):
     return flash_and_go("Filetype not supported yet", "failure", url_for("index"))
 
 
+ext_mimetypes = {v: k for k, v in ALLOWED_EXT_MIMETYPE.items()}
+
+
 # Returns the original file
-# * Reconsider if SQL is really required
 @app.route("/raw/<int:number>")
 def raw(number):
-    """Raw image from zip"""
-
-    cursor = get_db().cursor()
-    cursor.execute("select * from books where number = ?", (str(number),))
-    data = sqlresult_to_an_entry(cursor.fetchone())
+    """Original file, with range requests and precompressed variants"""
+    try:
+        file_real, filetype = book_file(number, get_db())
+    except IndexError:
+        abort(404)
+    filename = os.path.basename(file_real)
+    mimetype = ext_mimetypes.get(filetype, "application/octet-stream")
+
+    # nginx sends the file (and its variants with gzip_static)
+    if RAW_DELIVERY == "x-accel-redirect":
+        response = make_response("")
+        response.headers["X-Accel-Redirect"] = X_ACCEL_PREFIX + filename
+        response.headers["Content-Type"] = mimetype
+        return response
+
+    file_real, encoding = precompressed_variant(
+        file_real, filetype, request.accept_encodings
+    )
 
-    return redirect(
-        url_for("static", filename="documents/" + str(number) + "." + data["filetype"])
+    # Range and If-Range are handled by conditional response
+    response = send_file(
+        file_real,
+        mimetype=mimetype,
+        download_name=filename,
+        conditional=True,
+        max_age=3000,
     )
+    if filetype in PRECOMPRESS_FILETYPES:
+        response.vary.add("Accept-Encoding")
+    if encoding is not None:
+        response.headers["Content-Encoding"] = encoding
+    return response
 
 
 # Returns the image of a page
@@ -416,29 +547,141 @@ def raw(number):
 def page_image(number, page, shrink=IMG_SHRINK):
     """Shrink or rendered image from pdf/zip"""
 
-    cursor = get_db().cursor()
-    cursor.execute("select * from books where number = ?", (str(number),))
-    data = sqlresult_to_an_entry(cursor.fetchone())
     query = request.args.get("query", type=str, default="")
 
-    filetype = data["filetype"]
-    filename = str(number) + f".{filetype}"
-    file_real = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-
     try:
-        if filetype == "pdf":
-            img = pdf2img(file_real, page=page, dpi=PDF_IMG_DPI, query=query)
-            imgtype, imgmode = None, None
-        elif filetype == "zip":
-            img, imgtype, imgmode = zipcat(file_real, page=page)
-        else:
-            return flash_and_go("Image not supported yet", "failure", url_for("index"))
+        _, filetype = book_file(number, get_db())
+        data, imgtype = render_page(number, filetype, page, query=query, shrink=shrink)
+        return send_image(data, imgtype)
 
-        return send_pil_image(img, imgtype=imgtype, imgmode=imgmode, shrink=shrink)
+    except TypeError:
+        return flash_and_go("Image not supported yet", "failure", url_for("index"))
 
     except IndexError:
         abort(404)
 
+    except Image.DecompressionBombError:
+        abort(422)  # Too big to decode
+
+
+# Returns the thumbnail, generated when it is missing
+@app.route("/thumb/<int:number>/<size>")
+def thumbnail(number, size):
+    """Thumbnail image (WebP if the browser accepts)"""
+    if size not in THUMB_SIZES:
+        abort(404)
+
+    imgtype = "webp" if request.accept_mimetypes["image/webp"] else "jpeg"
+    thumb_real = thumbnail_path(number, size, imgtype)
+
+    metrics.cache_result("thumbnail", os.path.exists(thumb_real))
+    if not os.path.exists(thumb_real):
+        cursor = get_db().cursor()
+        cursor.execute("select filetype from books where number = ?", (number,))
+        try:
+            data = sqlresult_to_an_entry(cursor.fetchone())
+            make_thumbnails(number, data["filetype"])
+        except BOOK_FILE_ERRORS:
+            abort(404)
+
+    response = make_response(
+        send_file(thumb_real, mimetype=IMG_MIMETYPES[imgtype], max_age=3000)
+    )
+    response.vary.add("Accept")
+    return response
+
+
+# Returns the thumbnails of a grid page in one image
+@app.route("/thumbsheet")
+def thumbsheet():
+    """Sprite sheet of thumbnails, cached by book numbers and md5s"""
+    try:
+        numbers = [int(n) for n in request.args.get("ids", "").split(",")]
+    except ValueError:
+        abort(404)
+    numbers = numbers[:THUMBSHEET_MAX]
+
+    entries = select_books(numbers, get_db(), "number, md5, filetype")
+    if not entries:
+        abort(404)
+
+    imgtype = "webp" if request.accept_mimetypes["image/webp"] else "jpeg"
+    key = thumbsheet_key((e["number"], e["md5"]) for e in entries)
+    sheet_real = thumbsheet_path(key, imgtype)
+    metrics.cache_result("thumbsheet", os.path.exists(sheet_real))
+    if not os.path.exists(sheet_real):
+        make_thumbsheet(
+            [(e["number"], e["filetype"]) for e in entries], sheet_real, imgtype
+        )
+
+    response = make_response(
+        send_file(sheet_real, mimetype=IMG_MIMETYPES[imgtype], max_age=86400)
+    )
+    response.vary.add("Accept")
+    return response
+
+
+# Returns sizes and placeholder colours of the pages, made when missing
+@app.route("/manifest/<int:number>")
+def manifest(number):
+    """Page manifest of pdf/zip (JSON)"""
+    manifest_real = manifest_path(number)
+
+    metrics.cache_result("manifest", os.path.exists(manifest_real))
+    if not os.path.exists(manifest_real):
+        try:
+            _, filetype = book_file(number, get_db())
+            make_manifest(number, filetype)
+        except BOOK_FILE_ERRORS:
+            abort(404)
+
+    return send_file(manifest_real, mimetype="application/json", max_age=3000)
+
+
+# Deep zoom: size of the page and its tiles
+@app.route("/tile/<int:number>/<int:page>")
+def tile_info(number, page):
+    """Full size and zoom levels of the page (JSON)"""
+    try:
+        _, filetype = book_file(number, get_db())
+        width, height = tile_page_size(number, filetype, page)
+    except BOOK_FILE_ERRORS:
+        abort(404)
+    except Image.DecompressionBombError:
+        abort(422)  # Too big to decode
+
+    levels = tile_levels(width, height)
+    return {"width": width, "height": height, "tile_size": TILE_SIZE, "levels": levels}
+
+
+@app.route("/tile/<int:number>/<int:page>/<int:z>/<int:x>/<int:y>")
+def tile(number, page, z, x, y):
+    """Tile of the page at zoom level z (0: whole page in a tile)"""
+    tile_real = tile_path(number, page, z, x, y)
+
+    metrics.cache_result("tile", os.path.exists(tile_real))
+    if not os.path.exists(tile_real):
+        try:
+            _, filetype = book_file(number, get_db())
+            render_tile(number, filetype, page, z, x, y)
+        except BOOK_FILE_ERRORS:
+            abort(404)
+        except Image.DecompressionBombError:
+            abort(422)  # Too big to decode
+
+    return send_file(tile_real, mimetype="image/jpeg", max_age=86400)
+
+
+# Metrics of all the workers
+@app.route("/metrics")
+def show_metrics():
+    """Prometheus text format"""
+    if not METRICS_ENABLED:
+        abort(404)
+    response = make_response(metrics.exposition())
+    response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    return response
+
 
 # Uploading
 # *** REFACT *** ...which variable space should be used?
@@ -459,6 +702,8 @@ def get_remote_file(url):
     if url == "" or url is None:
         return None
 
+    import requests  # Only for uploading from URL
+
     try:
         response = requests.get(url, timeout=60)
     except requests.exceptions.RequestException:
@@ -512,7 +757,13 @@ def upload_file():
                     "success",
                 )
 
-            except (TypeError, OSError, KeyError, IndexError) as e:
+            except (
+                TypeError,
+                OSError,
+                KeyError,
+                IndexError,
+                Image.DecompressionBombError,
+            ) as e:
                 flash(str(e), "failed")
                 continue
 
@@ -619,8 +870,7 @@ def edit_metadata(number):
     cursor = get_db().cursor()
 
     if request.method == "POST":
-        cursor.execute("select name, type from pragma_table_info('books')")
-        col_type = dict([d[0:2] for d in cursor.fetchall()])
+        col_type = book_column_types(cursor)
 
         form_data = dict(request.form.items())
         data = dict2sql(form_data, col_type)
@@ -628,6 +878,7 @@ def edit_metadata(number):
         named_sql = ",".join([f"{k}=:{k}" for k in col_type.keys() if k != "number"])
         sql_values = {k: data[k] for k in col_type.keys()}
         cursor.execute(f"update books set {named_sql} where number=:number", sql_values)
+        index_metadata(data["number"], cursor)
         cursor.connection.commit()
         flash("Data has been modified", "success")
 
@@ -644,6 +895,60 @@ def edit_metadata(number):
         return render_template("edit_metadata.html", data=data, hide_keys=HIDE_KEYS)
 
 
+@app.route("/edit_books", methods=["POST"])
+def edit_books_wrapper():
+    """
+    Edit metadata of many books in one transaction
+    Books: numbers (separated by commas or spaces), or query and/or
+    tag, filetype, date_from, date_to and hidden as in search
+    Changes: add_tags, remove_tags (separated by spaces), r2l, spread and
+    hide (1 or 0). Goes to next if given, or returns JSON.
+    """
+    form = request.form
+    cursor = get_db().cursor()
+    filters, params = search_filters(form)
+
+    if form.get("numbers", "").strip():
+        try:
+            numbers = [int(n) for n in form["numbers"].replace(",", " ").split()]
+        except ValueError:
+            abort(400)
+    elif form.get("query", "").strip():
+        query_merged = query_cleaner(form["query"])
+        numbers = list(search_books(cursor, query_merged, filters, params)[0])
+    elif len(params) > 0:
+        # Filters only (e.g. all the books with a tag)
+        cursor.execute(f"select number from books where {filters}", params)
+        numbers = [r["number"] for r in cursor.fetchall()]
+    else:
+        abort(400)  # Not the whole library by mistake
+
+    # Back to a page of this site, if asked
+    next_page = form.get("next", "")
+    if not next_page.startswith("/") or next_page.startswith("//"):
+        next_page = None
+
+    flags = {k: form[k] == "1" for k in EDIT_FLAGS if form.get(k, "") in ("0", "1")}
+    try:
+        edited = edit_books(
+            numbers,
+            cursor,
+            add_tags=form.get("add_tags", "").split(),
+            remove_tags=form.get("remove_tags", "").split(),
+            flags=flags,
+        )
+        cursor.connection.commit()
+    except sqlite3.Error as e:
+        cursor.connection.rollback()
+        if next_page:
+            return flash_and_go(f"SQL Error {e}", "failed", next_page)
+        return {"error": str(e)}, 500
+
+    if next_page:
+        return flash_and_go(f"{edited} books were modified", "success", next_page)
+    return {"edited": edited}
+
+
 # Remove entry
 # for foolproof this cannot be called by GET.
 @app.route("/remove", methods=["POST"])
@@ -666,7 +971,7 @@ def remove_wrapper():
 def refresh_wrapper(number):
     """Refresh the entry: Generate thumbnail and text index"""
     try:
-        refresh_entry(number, get_db())
+        refresh_entry(number, get_db(write=True))
         return flash_and_go(
             f"Index successfully updated for #{number}", "success", url_for("index")
         )
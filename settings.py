@@ -22,7 +22,8 @@ HIDE_KEYS = [
 ]
 
 # Search settings
-EPUB_CHUNK_SPLIT = 100
+EPUB_CHUNK_CHARS = 1000  # Target length of a text chunk of EPUB
+FTS_INSERT_BATCH = 1000  # Rows held in memory while inserting text index
 
 # Directories
 script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -31,6 +32,28 @@ THUMBDIR_PATH = script_dir + "/static/thumbnails"
 DATABASE_PATH = script_dir + "/data/data.db"
 SCHEMA_PATH = script_dir + "/data/schema.sql"
 
+# Rendered markdown (HTML and text) cached by content hash
+MD_CACHE_PATH = script_dir + "/data/md_cache"
+MD_CACHE_MAX = 1000  # Notes kept in cache
+
+# Library-wide reindexing (fmfm_util.py update --all)
+REINDEX_BATCH_SIZE = 100  # Books per transaction
+REINDEX_WORKERS = os.cpu_count() or 1
+REINDEX_NICE = 10  # Priority drop of workers when throttled
+REINDEX_CHECKPOINT_PATH = script_dir + "/data/reindex_checkpoint.json"
+
+# Thumbnails: size name -> bounding box (px). Each is saved in every format.
+THUMB_SIZES = {"large": 400, "small": 200}
+THUMB_FORMATS = {"jpeg": "jpg", "webp": "webp"}  # PIL format -> suffix
+THUMB_QUALITY = 85
+
+# Sprite sheet of thumbnails for the grid view
+THUMBSHEET_DIR = THUMBDIR_PATH + "/sheets"
+THUMBSHEET_CELL = (200, 300)  # Pixels per thumbnail in the sheet (shown at half)
+THUMBSHEET_COLUMNS = 10
+THUMBSHEET_MAX = 500  # Thumbnails per sheet; rest are sent one by one
+THUMBSHEET_CACHE_MAX = 200  # Sheets kept on disk
+
 # Filetype settings
 ALLOWED_EXT_MIMETYPE = {
     "application/pdf": "pdf",
@@ -39,6 +62,14 @@ ALLOWED_EXT_MIMETYPE = {
     "text/markdown": "md",
 }
 
+# Delivery of original files (/raw): "python", "x-sendfile" or "x-accel-redirect"
+# (for x-accel-redirect, see the internal location in nginx_conf.sample)
+RAW_DELIVERY = "python"
+X_ACCEL_PREFIX = "/_documents/"
+# Filetypes stored with gzip/brotli variants, sent if the browser accepts
+PRECOMPRESS_FILETYPES = ("md",)
+PRECOMPRESS_ENCODINGS = {"br": ".br", "gzip": ".gz"}  # In order of preference
+
 # Images in zip file
 IMG_MIMETYPES = {
     "png": "image/png",
@@ -55,8 +86,74 @@ IMG_SUFFIX = tuple(f".{k}" for k in IMG_MIMETYPES)
 # True to shrink image into JPEG when transferred
 IMG_SHRINK = True
 
+# Processes rendering pages per worker in async serving mode (asgi.py)
+RENDER_PROCESSES = 2
+RENDER_QUEUE_SIZE = 16  # Waiting pages; more are refused with 503
+RENDER_DEADLINE = 30.0  # Seconds a viewed page may wait in the queue
+RENDER_PRELOAD_DEADLINE = 5.0  # Same for preloads (X-Render-Priority: low)
+RENDER_RETRY_AFTER = 2  # Retry-After (seconds) when refused
+FLASK_THREADS = 10  # Threads serving the other (Flask) routes per worker
+
 # PDF image DPI
 PDF_IMG_DPI = 175
 
+# PDFs larger than this get a linearized copy for rendering (needs qpdf)
+PDF_LINEARIZE_MIN_SIZE = 50 * 1024 * 1024  # bytes
+LINEARIZED_DIR = script_dir + "/data/linearized"
+PDF_DOC_CACHE = 8  # Parsed PDFs kept per worker
+ZIP_MAP_CACHE = 32  # Zips kept memory-mapped per worker
+
 # Maximum size of shrunk image (if larger than this value)
 IMG_SHRINK_WIDTH, IMG_SHRINK_HEIGHT = 3840, 2160
+# Memory a decoded zip image may take (after reduced-resolution decoding)
+IMG_DECODE_MAX_BYTES = 512 * 1024 * 1024
+
+# Page manifest (sizes and placeholder colours for the viewer), made at indexing
+MANIFEST_DIR = script_dir + "/data/manifests"
+MANIFEST_CACHE = 64  # Manifests kept per worker
+# Pages without colour are rendered and sent in grayscale (JPEG), and
+# black-and-white ones in 1 bit (PNG) if PAGE_BILEVEL_PNG; told at indexing,
+# colour from a sample and black and white at full size (strokes blur when
+# reduced)
+PAGE_SAMPLE_SIZE = 320  # Long side (px) of the sample for colours
+PAGE_BILEVEL_STRIPS = 12  # Full-height strips across the page checked for gray
+PAGE_BILEVEL_STRIP_WIDTH = 64  # Width (px) of each strip
+PAGE_COLOR_MIN_CHROMA = 24  # Pixels more colourful than this (0-255) count
+PAGE_COLOR_MIN_PIXELS = 0.002  # Fraction of colourful pixels of a colour page
+PAGE_BILEVEL_MAX_MIDTONES = 0.02  # Fraction of gray pixels of a bilevel page
+PAGE_BILEVEL_PNG = True  # False: bilevel pages are sent as grayscale JPEG
+
+# Deep zoom: pages cut into tiles, each level half the size of the next
+TILE_SIZE = 512  # Pixels per side
+TILE_PDF_DPI = 400  # Resolution of PDF at the deepest level (zip: original size)
+TILE_QUALITY = 90
+TILE_DIR = script_dir + "/data/tiles"
+TILE_CACHE_MAX = 20000  # Tiles kept on disk
+TILE_PRUNE_INTERVAL = 200  # Old tiles removed every N tiles made
+
+# Metrics (Prometheus text format at /metrics)
+METRICS_ENABLED = True
+METRICS_DIR = script_dir + "/data/metrics"  # Values of each process
+METRICS_FLUSH_INTERVAL = 5.0  # Seconds between writes per process
+
+# Profiling (opt-in): a sample of requests is profiled, and saved if slow
+PROFILE_ENABLED = False
+PROFILE_SAMPLE_RATE = 0.05  # Ratio of requests profiled
+PROFILE_SLOW_SECONDS = 1.0  # Saved if slower than this
+PROFILE_HEADER = "X-FMFM-Profile"  # Requests with this header are always saved
+PROFILE_DIR = script_dir + "/data/profiles"
+PROFILE_KEEP = 100  # Newest profiles kept
+
+# SQLite connections (kept per worker)
+DB_READERS = 8  # Read-only connections per worker
+DB_CACHE_KIB = 16 * 1024  # Page cache per connection
+DB_MMAP_SIZE = 256 * 1024 * 1024  # Memory-mapped I/O (bytes)
+DB_STATEMENT_CACHE = 512  # Prepared statements kept per connection
+DB_BUSY_TIMEOUT = 30.0  # Seconds to wait for the other processes' writes
+DB_WAL = True  # Readers don't wait for writes (not for network filesystems)
+
+# Search ranking: weight of title and tags hits over page text (bm25)
+SEARCH_TITLE_WEIGHT = 10.0
+SEARCH_TAGS_WEIGHT = 5.0
+SEARCH_EXCERPTS = 10  # Hit pages shown per book
+SEARCH_FACET_TAGS = 20  # Tags shown to narrow the result
@@ -117,11 +117,20 @@ var image_handler = (function () {
 //// ---- Image obtaining ---- ////
 // Delay loading
 function image_loader(list) {
-  async function load(src) {
+  async function load(src, retry = 3) {
     if (src) {
       const img = new Image();
       img.src = src;
-      await img.decode();
+      try {
+        await img.decode();
+      } catch (e) {
+        // Server may be busy (503); try again a bit later
+        if (retry <= 0) {
+          throw e;
+        }
+        await new Promise(r => setTimeout(r, 1000));
+        return load(src, retry - 1);
+      }
       return img;
 
     } else {
@@ -133,60 +142,103 @@ function image_loader(list) {
 }
 
 // Image preloading
-async function preload(pos, direction, size = 6) {
+// Requested with low priority, and aborted when the page moves again
+var preload_controller = null;
+
+async function preload(pos, direction, signal, size = 6) {
   if (direction == "right") {
     _list = img_list.slice(pos, pos + size);
   } else {
     _list = img_list.slice(pos - size, pos);
     _list.reverse();
   }
-  return await image_loader(_list);
+  // Responses are kept in the browser cache for drawing
+  return await Promise.allSettled(_list.filter(s => s).map(
+    s => fetch(s, { headers: { "X-Render-Priority": "low" }, signal: signal }).then(r => r.blob())
+  ));
 }
 
 //// ---- Drawing  ---- ////
-// Drawing to canvas func.
-async function draw(src1, src2) {
-  // Changes the cursor
-  canvas.style.cursor = "wait";
+// Page sizes and placeholder colours, known before the images come
+var manifest = null;
+fetch("/manifest/" + number)
+  .then(r => r.ok ? r.json() : null)
+  .then(m => { manifest = m; })
+  .catch(e => console.log("No manifest: " + e));
+
+function page_of(src) {
+  return Number(src.match(/\/img\/\d+\/(\d+)/)[1]);
+}
 
-  let img1, img2
-  [img1, img2] = await image_loader([src1, src2]);
+function page_info(src) {
+  if (!manifest || !src) {
+    return null;
+  }
+  return manifest.pages[page_of(src)] || null;
+}
 
-  if (img1 && img2) {
+// Rectangles [x, y, w, h] of the pages in the canvas; size: {width, height} or null
+function placement(size1, size2) {
+  if (size1 && size2) {
     // width-first
-    w1 = img1.width * (canvas.height / img1.height);
-    w2 = img2.width * (canvas.height / img2.height);
-    // height-first
-    h1 = img1.height * (canvas.width / img1.width);
-    h2 = img2.height * (canvas.width / img2.width);
+    w1 = size1.width * (canvas.height / size1.height);
+    w2 = size2.width * (canvas.height / size2.height);
 
     if (w1 + w2 > canvas.width) {
       // shrink height limited by width
       ratio = canvas.width / (w1 + w2);
       height_imgs = canvas.height * ratio;
       img_hpos = (canvas.height - height_imgs) / 2;
-      ctx.drawImage(img1, 0, img_hpos, w1 * ratio, height_imgs);
-      ctx.drawImage(img2, w1 * ratio, img_hpos, w2 * ratio, height_imgs);
+      return [[0, img_hpos, w1 * ratio, height_imgs], [w1 * ratio, img_hpos, w2 * ratio, height_imgs]];
     } else {
       // shrink width limited by height
       img_wpos = (canvas.width - w1 - w2) / 2;
-      ctx.drawImage(img1, img_wpos, 0, w1, canvas.height);
-      ctx.drawImage(img2, w1 + img_wpos, 0, w2, canvas.height);
+      return [[img_wpos, 0, w1, canvas.height], [w1 + img_wpos, 0, w2, canvas.height]];
     }
 
-  } else if (img1 || img2) {
-    img_single = img1 || img2;
-    h_img = img_single.height * (canvas.width / img_single.width);
-    w_img = img_single.width * (canvas.height / img_single.height);
+  } else if (size1 || size2) {
+    size = size1 || size2;
+    h_img = size.height * (canvas.width / size.width);
+    w_img = size.width * (canvas.height / size.height);
 
     if (w_img > canvas.width) {
       // shrink height limited by width
-      ctx.drawImage(img_single, 0, (canvas.height - h_img) / 2, canvas.width, h_img);
+      rect = [0, (canvas.height - h_img) / 2, canvas.width, h_img];
     } else {
       // shrink width limited by height
-      ctx.drawImage(img_single, (canvas.width - w_img) / 2, 0, w_img, canvas.height);
+      rect = [(canvas.width - w_img) / 2, 0, w_img, canvas.height];
     }
+    return size1 ? [rect, null] : [null, rect];
+  }
+  return [null, null];
+}
+
+// Drawing to canvas func.
+async function draw(src1, src2) {
+  // Changes the cursor
+  canvas.style.cursor = "wait";
+
+  // Placeholders in the page colours, while the images are rendered
+  let info1 = page_info(src1), info2 = page_info(src2);
+  if (info1 || info2) {
+    ctx.clearRect(0, 0, canvas.width, canvas.height);
+    placement(info1, info2).forEach((rect, i) => {
+      if (rect) {
+        ctx.fillStyle = [info1, info2][i].color;
+        ctx.fillRect(...rect);
+      }
+    });
+  }
+
+  let img1, img2
+  [img1, img2] = await image_loader([src1, src2]);
 
+  if (img1 || img2) {
+    placement(img1, img2).forEach((rect, i) => {
+      if (rect) {
+        ctx.drawImage([img1, img2][i], ...rect);
+      }
+    });
   } else {
     console.log("No images are found.");
   }
@@ -195,6 +247,103 @@ async function draw(src1, src2) {
   canvas.style.cursor = "auto";
 }
 
+//// ---- Zoom ---- ////
+// Zoom mode shows the current page in tiles; only the visible ones are fetched
+// zoom: {page, info, z, x, y}, x and y are the view center in full size pixels
+var zoom = null;
+var tiles = new Map(); // URL -> Image
+
+async function zoom_toggle() {
+  const checkbox = document.getElementById("zoom");
+  if (!checkbox.checked) {
+    zoom_off();
+    return;
+  }
+
+  let src1, src2;
+  [src1, src2] = image_handler.path();
+  const src = src1 || src2;
+  const response = src ? await fetch("/tile/" + number + "/" + page_of(src)) : null;
+  if (!response || !response.ok) {
+    checkbox.checked = false;
+    return;
+  }
+  const info = await response.json();
+
+  // Starts from the level that fits the canvas
+  const fit = Math.floor(Math.log2(Math.max(info.width / canvas.width, info.height / canvas.height)));
+  zoom = {
+    page: page_of(src),
+    info: info,
+    z: Math.max(0, Math.min(info.levels - 1, info.levels - 1 - fit)),
+    x: info.width / 2,
+    y: info.height / 2,
+  };
+  redraw();
+}
+
+function zoom_off() {
+  zoom = null;
+  tiles.clear();
+  document.getElementById("zoom").checked = false;
+  redraw();
+}
+
+function zoom_scale() {
+  // Full size pixels per pixel of the level
+  return 2 ** (zoom.info.levels - 1 - zoom.z);
+}
+
+function zoom_in(step) {
+  zoom.z = Math.max(0, Math.min(zoom.info.levels - 1, zoom.z + step));
+  draw_tiles();
+}
+
+function zoom_pan(dx, dy) {
+  // dx, dy in canvas pixels
+  zoom.x = Math.max(0, Math.min(zoom.info.width, zoom.x + dx * zoom_scale()));
+  zoom.y = Math.max(0, Math.min(zoom.info.height, zoom.y + dy * zoom_scale()));
+  draw_tiles();
+}
+
+function draw_tiles() {
+  const size = zoom.info.tile_size;
+  const scale = zoom_scale();
+  const level_w = Math.ceil(zoom.info.width / scale);
+  const level_h = Math.ceil(zoom.info.height / scale);
+  // Top left of the canvas in the level
+  const left = zoom.x / scale - canvas.width / 2;
+  const top = zoom.y / scale - canvas.height / 2;
+
+  ctx.clearRect(0, 0, canvas.width, canvas.height);
+  for (let y = Math.max(0, Math.floor(top / size)); y * size < Math.min(level_h, top + canvas.height); y++) {
+    for (let x = Math.max(0, Math.floor(left / size)); x * size < Math.min(level_w, left + canvas.width); x++) {
+      const src = "/tile/" + number + "/" + zoom.page + "/" + zoom.z + "/" + x + "/" + y;
+      let img = tiles.get(src);
+      if (!img) {
+        // Drawn when it comes (the view may have moved meanwhile)
+        img = new Image();
+        img.src = src;
+        tiles.set(src, img);
+        img.decode().then(() => { if (zoom) draw_tiles(); }).catch(() => tiles.delete(src));
+      } else if (img.complete && img.naturalWidth) {
+        ctx.drawImage(img, x * size - left, y * size - top);
+      }
+    }
+  }
+}
+
+// Drag to move around
+var drag_from = null;
+canvas.addEventListener("mousedown", (e) => { drag_from = [e.clientX, e.clientY]; });
+canvas.addEventListener("mouseup", () => { drag_from = null; });
+canvas.addEventListener("mousemove", (e) => {
+  if (zoom && drag_from) {
+    zoom_pan((drag_from[0] - e.clientX) * expansion, (drag_from[1] - e.clientY) * expansion);
+    drag_from = [e.clientX, e.clientY];
+  }
+});
+
 // Drawing wrapper
 // Todo(bug): this drawing a bit exceeds iPad's screen.
 function redraw() {
@@ -213,6 +362,11 @@ function redraw() {
     spread = document.getElementById("spread").checked; // By default is read from DB
   }
 
+  if (zoom) {
+    draw_tiles();
+    return;
+  }
+
   // get image path
   let src1, src2;
   [src1, src2] = image_handler.path();
@@ -222,6 +376,10 @@ function redraw() {
 //// ---- Interfacing ---- ////
 // Page moving wrapper
 function pagemove(direction, pos = null) {
+  if (zoom) {
+    zoom_off();
+  }
+
   if (pos != null) {
     image_handler.set_pos(pos);
   } else {
@@ -244,16 +402,23 @@ function pagemove(direction, pos = null) {
 
   // Preload
   // REFACT? need to separate semantic of "right" in moving and preloading context
+  if (preload_controller) {
+    preload_controller.abort();
+  }
+  preload_controller = new AbortController();
   if (direction == "right" || direction == "both") {
-    preload(pos, "right");
+    preload(pos, "right", preload_controller.signal);
   }
   if (direction == "left" || direction == "both") {
-    preload(pos, "left");
+    preload(pos, "left", preload_controller.signal);
   }
 }
 
 // Click interface
 canvas.addEventListener("click", (e) => {
+  if (zoom) {
+    return; // Dragging
+  }
   const rect = canvas.getBoundingClientRect();
   const point = {
     x: e.clientX - rect.left,
@@ -273,6 +438,17 @@ function keyboardEvent(event) {
     return
   }
 
+  if (event.type === "keydown" && zoom) {
+    // Arrow keys move around in zoom mode
+    const step = canvas.width / 4;
+    const moves = { ArrowLeft: [-step, 0], ArrowRight: [step, 0], ArrowUp: [0, -step], ArrowDown: [0, step] };
+    if (event.code in moves) {
+      event.preventDefault();
+      zoom_pan(...moves[event.code]);
+      return;
+    }
+  }
+
   if (event.type === "keydown") {
     switch (event.code) {
       case "ArrowLeft":
@@ -291,6 +467,10 @@ function keyboardEvent(event) {
         document.getElementById('pageshift').click();
         break;
 
+      case "KeyZ":
+        document.getElementById('zoom').click();
+        break;
+
       case "KeyF":
         event.preventDefault();
         document.getElementById('search_query').blur();
@@ -304,6 +484,11 @@ addEventListener("keydown", keyboardEvent);
 
 // Wheel triggers the page movement.
 function wheelEvent(event) {
+  if (event.type === "wheel" && zoom) {
+    zoom_in(event.deltaY < 0 ? 1 : -1);
+    return;
+  }
+
   if (event.type === "wheel") {
     // The point is that user don't want to reverse the wheel direction!
     // So here the direction is reversed when R2L is on.
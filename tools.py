@@ -12,32 +12,46 @@ import math
 import unicodedata
 import hashlib
 import zipfile
+import zlib
+import fcntl
+import mmap
+import struct
 import shutil
 import functools
+import subprocess
+import itertools
+import posixpath
+import gzip
+import json
+from urllib.parse import unquote
+from datetime import datetime
 
 # DB
 import sqlite3
 from contextlib import closing
 
 # ZIP
-from PIL import Image, ImageOps, ImageFont, ImageDraw
+from PIL import Image, ImageOps, ImageChops
 
-# PDF
-import poppler
-from poppler import PageRenderer, RenderHint, CaseSensitivity, Rectangle
-from poppler.cpp import page as pp_page
+# PDF (poppler), markdown (markdown, bs4) and fonts (PIL) are imported in
+# the functions when first needed, so that workers and CLI start fast.
 
 # EPUB
-from ebooklib import epub
-from bs4 import BeautifulSoup
+from xml.etree import ElementTree
+from html.parser import HTMLParser
 
-# Markdown
-import markdown
+# Brotli is optional (precompressed variants)
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # Import from web
 from werkzeug.utils import secure_filename
 from werkzeug.datastructures import FileStorage
 
+import metrics
+
 # FMFM settings
 from settings import (
     DATABASE_PATH,
@@ -45,22 +59,75 @@ from settings import (
     IMG_SUFFIX,
     UPLOADDIR_PATH,
     THUMBDIR_PATH,
-    EPUB_CHUNK_SPLIT,
+    THUMB_SIZES,
+    THUMB_FORMATS,
+    THUMB_QUALITY,
+    THUMBSHEET_DIR,
+    THUMBSHEET_CELL,
+    THUMBSHEET_COLUMNS,
+    THUMBSHEET_CACHE_MAX,
+    EPUB_CHUNK_CHARS,
+    FTS_INSERT_BATCH,
+    MD_CACHE_PATH,
+    MD_CACHE_MAX,
+    PRECOMPRESS_FILETYPES,
+    PDF_LINEARIZE_MIN_SIZE,
+    LINEARIZED_DIR,
+    PDF_DOC_CACHE,
+    ZIP_MAP_CACHE,
+    PRECOMPRESS_ENCODINGS,
+    PDF_IMG_DPI,
+    SEARCH_TITLE_WEIGHT,
+    SEARCH_TAGS_WEIGHT,
+    IMG_SHRINK,
+    IMG_SHRINK_WIDTH,
+    IMG_SHRINK_HEIGHT,
+    IMG_DECODE_MAX_BYTES,
+    MANIFEST_DIR,
+    MANIFEST_CACHE,
+    PAGE_SAMPLE_SIZE,
+    PAGE_BILEVEL_STRIPS,
+    PAGE_BILEVEL_STRIP_WIDTH,
+    PAGE_COLOR_MIN_CHROMA,
+    PAGE_COLOR_MIN_PIXELS,
+    PAGE_BILEVEL_MAX_MIDTONES,
+    PAGE_BILEVEL_PNG,
+    TILE_SIZE,
+    TILE_PDF_DPI,
+    TILE_QUALITY,
+    TILE_DIR,
+    TILE_CACHE_MAX,
+    TILE_PRUNE_INTERVAL,
 )
 
 # Markdown parser
-md_ext = functools.partial(
-    markdown.markdown,
-    extensions=["footnotes", "tables", "nl2br", "sane_lists", "fenced_code"],
-)
+MD_EXTENSIONS = ["footnotes", "tables", "nl2br", "sane_lists", "fenced_code"]
+
+
+def md_ext(md):
+    """Markdown -> HTML"""
+    import markdown
+
+    return markdown.markdown(md, extensions=MD_EXTENSIONS)
+
 
-# PDF renderer of poppler
-renderer = PageRenderer()
+@functools.cache
+def pdf_renderer():
+    """PDF renderer of poppler (made once per process)"""
+    from poppler import PageRenderer
+
+    return PageRenderer()
+
+
+# qpdf command to linearize PDF (optional)
+QPDF = shutil.which("qpdf")
 
 
 def init_db():
     """DB Initialization"""
     if os.path.exists(DATABASE_PATH):
+        with closing(sqlite3.connect(DATABASE_PATH)) as db:
+            upgrade_db(db)
         return
 
     with closing(sqlite3.connect(DATABASE_PATH)) as db:
@@ -73,6 +140,40 @@ def init_db():
     os.makedirs(THUMBDIR_PATH, exist_ok=True)
 
 
+def upgrade_db(database):
+    """Bring a DB made by older versions up to date"""
+    cursor = database.cursor()
+    cursor.execute("select name from sqlite_master where name = 'meta_fts'")
+    if cursor.fetchone() is None:
+        # Title and tags index (rowid is the book number)
+        cursor.execute(
+            "create virtual table if not exists meta_fts using fts5(title, tags)"
+        )
+        cursor.execute("select number from books")
+        for (number,) in cursor.fetchall():
+            index_metadata(number, cursor)
+        database.commit()
+
+    # Registered date of books added by older versions: when the file was saved
+    cursor.execute(
+        "select number, filetype, modified_date from books"
+        " where coalesce(registered_date, '') = ''"
+    )
+    for number, filetype, registered in cursor.fetchall():
+        if not registered:
+            file_real = os.path.join(UPLOADDIR_PATH, f"{number}.{filetype}")
+            try:
+                mtime = datetime.fromtimestamp(os.path.getmtime(file_real))
+            except OSError:
+                continue  # No file: left unknown
+            registered = mtime.strftime("%Y-%m-%d %H:%M:%S")
+        cursor.execute(
+            "update books set registered_date = ? where number = ?",
+            (registered, number),
+        )
+    database.commit()
+
+
 def sqlresult_to_an_entry(result):
     """SQlite3 Row -> Dict with error handling"""
     try:
@@ -81,26 +182,157 @@ def sqlresult_to_an_entry(result):
         raise IndexError from exc
 
 
+# Book number -> filetype
+# A number keeps its file while it exists, so DB lookup can be skipped.
+filetypes = {}
+
+
+def book_file(book_number, database):
+    """Path and filetype of the book file"""
+    filetype = filetypes.get(book_number)
+    if filetype is not None:
+        file_real = os.path.join(UPLOADDIR_PATH, f"{book_number}.{filetype}")
+        if os.path.exists(file_real):
+            return file_real, filetype
+
+    # Unknown, or removed (the number can be reused)
+    cursor = database.cursor()
+    cursor.execute("select filetype from books where number = ?", (book_number,))
+    filetype = sqlresult_to_an_entry(cursor.fetchone())["filetype"]
+    filetypes[book_number] = filetype
+    return os.path.join(UPLOADDIR_PATH, f"{book_number}.{filetype}"), filetype
+
+
+def select_books(book_numbers, database, columns="*"):
+    """Rows of the books, in the order of book_numbers (missing are skipped)"""
+    book_numbers = list(book_numbers)
+    placeholder = ",".join("?" * len(book_numbers))
+    cursor = database.cursor()
+    cursor.execute(
+        f"select {columns} from books where number in ({placeholder})", book_numbers
+    )
+    found = {e["number"]: e for e in cursor.fetchall()}
+    return [found[n] for n in book_numbers if n in found]
+
+
+def precompressed_variant(file_real, filetype, accept_encodings):
+    """
+    Precompressed file which the browser accepts -> (path, encoding)
+    accept_encodings: Werkzeug's Accept of Accept-Encoding header
+    """
+    if filetype in PRECOMPRESS_FILETYPES:
+        for encoding, suffix in PRECOMPRESS_ENCODINGS.items():
+            if accept_encodings[encoding] and os.path.exists(file_real + suffix):
+                return file_real + suffix, encoding
+    return file_real, None
+
+
+# Errors of a missing, unsupported or damaged book file
+BOOK_FILE_ERRORS = (IndexError, TypeError, OSError, zipfile.BadZipFile)
+
+
+# PDF loading
+def open_pdf(filename):
+    """Parse PDF; OSError if poppler cannot read it"""
+    import poppler
+
+    try:
+        pdf = poppler.load_from_file(filename)
+        pdf.pages  # A damaged file gives an empty document
+    except (AttributeError, RuntimeError, ValueError) as exc:
+        raise OSError(f"Cannot read PDF: {filename}") from exc
+    return pdf
+
+
+@functools.lru_cache(maxsize=PDF_DOC_CACHE)
+def load_pdf_cached(filename, mtime):
+    """Parsed PDF kept per worker; mtime is the key for modified files"""
+    return open_pdf(filename)
+
+
+def load_pdf(filename):
+    """Parsed PDF, without parsing again while it is cached"""
+    hits = load_pdf_cached.cache_info().hits
+    pdf = load_pdf_cached(filename, os.path.getmtime(filename))
+    metrics.cache_result("pdf_doc", load_pdf_cached.cache_info().hits > hits)
+    return pdf
+
+
+def linearized_path(book_number):
+    """Path of the linearized copy of PDF"""
+    return os.path.join(LINEARIZED_DIR, f"{book_number}.pdf")
+
+
+def pdf_for_render(book_number, file_real):
+    """Linearized copy if exists (first page needs less reading), or original"""
+    lin_real = linearized_path(book_number)
+    return lin_real if os.path.exists(lin_real) else file_real
+
+
+@metrics.timed("linearize")
+def linearize_pdf(book_number, file_real):
+    """
+    Store a linearized copy of big PDF, used for rendering.
+    Small PDFs, or no qpdf command: the copy is not made (and removed).
+    """
+    lin_real = linearized_path(book_number)
+    if QPDF is None or os.path.getsize(file_real) < PDF_LINEARIZE_MIN_SIZE:
+        if os.path.exists(lin_real):
+            os.remove(lin_real)
+        return None
+
+    os.makedirs(LINEARIZED_DIR, exist_ok=True)
+    tmp_real = f"{lin_real}.{os.getpid()}.tmp"
+    result = subprocess.run(
+        [QPDF, "--linearize", file_real, tmp_real], capture_output=True, check=False
+    )
+    # qpdf: 0 = success, 3 = success with warnings
+    if result.returncode not in (0, 3):
+        if os.path.exists(tmp_real):
+            os.remove(tmp_real)
+        return None
+
+    os.replace(tmp_real, lin_real)
+    return lin_real
+
+
 # Image generation
-def pdf2img(filename, page=0, dpi=192, query="", antialias=True):
-    """PDF page to PIL image"""
-    pdf = poppler.load_from_file(filename)
+@metrics.timed("pdf_render")
+def pdf2img(
+    filename, page=0, dpi=192, query="", antialias=True, region=None, mode="RGB"
+):
+    """
+    PDF page to PIL image
+    region: (x, y, w, h) in pixels to render a part
+    mode: "RGB", or "L" for pages without colour (no highlight)
+    """
+    pdf = load_pdf(filename)
     if page >= pdf.pages:
         raise IndexError
 
+    from poppler import RenderHint
+
+    renderer = pdf_renderer()
     renderer.set_render_hint(RenderHint.text_antialiasing, antialias)
     renderer.set_render_hint(RenderHint.antialiasing, antialias)
     page = pdf.create_page(page)
-    image = renderer.render_page(page, xres=dpi, yres=dpi)
-
-    pil_image = Image.frombytes(
-        "RGBA",
-        (image.width, image.height),
-        image.data,
-        "raw",
-        str(image.format),
-    )
-    pil_image = pil_image.convert("RGB")
+    if region is None:
+        image = renderer.render_page(page, xres=dpi, yres=dpi)
+    else:
+        x, y, w, h = region
+        image = renderer.render_page(page, xres=dpi, yres=dpi, x=x, y=y, w=w, h=h)
+
+    # Read from the buffer of poppler in one pass (BGRA: alpha is dropped
+    # while unpacking); python-poppler 0.3+ gives it without a copy
+    data = image.memoryview() if hasattr(image, "memoryview") else image.data
+    size = (image.width, image.height)
+    if str(image.format) == "BGRA":
+        pil_image = Image.frombuffer("RGB", size, data, "raw", "BGRX", 0, 1)
+    else:
+        pil_image = Image.frombuffer("RGBA", size, data, "raw", str(image.format))
+        pil_image = pil_image.convert("RGB")
+    if mode != "RGB":
+        pil_image = pil_image.convert(mode)
 
     if query != "":
         query_list = (
@@ -111,9 +343,8 @@ def pdf2img(filename, page=0, dpi=192, query="", antialias=True):
             .split(" ")
         )
         query_list = [q for q in query_list if q != ""]
-        positions = [get_txt_pos_of_pdf(page, q) for q in query_list]
-        for p in positions:
-            pil_image = highlight_image_by_positions(pil_image, p, dpi=dpi)
+        positions = [p for q in query_list for p in get_txt_pos_of_pdf(page, q)]
+        highlight_image_by_positions(pil_image, positions, dpi=dpi)
 
     return pil_image
 
@@ -121,17 +352,21 @@ def pdf2img(filename, page=0, dpi=192, query="", antialias=True):
 def highlight_image_by_positions(
     img, positions, dpi=192, bgcolor=(255, 255, 0, 100), linecolor=(255, 0, 0, 200)
 ):
-    """Highlight specific position of image"""
-    img_new = img.convert("RGB")
-    draw = ImageDraw.Draw(img_new, "RGBA")
+    """Highlight specific position of image (RGB, drawn in place)"""
+    from PIL import ImageDraw
+
+    draw = ImageDraw.Draw(img, "RGBA")
     for p in positions:
         p_scaled = [v * dpi / 72 for v in p]
         draw.rectangle(p_scaled, fill=bgcolor, outline=linecolor, width=2)
-    return img_new.convert("RGB")
+    return img
 
 
 def get_txt_pos_of_pdf(page, txt, case_sensitive=False):
     """Highlight specific word of image"""
+    from poppler import CaseSensitivity, Rectangle
+    from poppler.cpp import page as pp_page
+
     case_sensitivity = (
         CaseSensitivity.case_sensitive
         if case_sensitive
@@ -166,28 +401,215 @@ def number_to_fixed_digits(s, digits=6):
     return s
 
 
-def zipcat(filename, page=None):
-    """Get file and number of files in a zip"""
-    # *** REFACT ***  split len and get #
-    with zipfile.ZipFile(filename) as archive:
-        entries = archive.namelist()
-        image_srcs = []
-        for i in entries:
-            if archive.getinfo(i).is_dir():
-                continue
-            if i.lower().endswith(IMG_SUFFIX):
-                image_srcs.append(i)
-        image_srcs = sorted(image_srcs, key=number_to_fixed_digits)
+def zip_images(archive):
+    """Image files in the zip, in page order"""
+    image_srcs = []
+    for info in archive.infolist():
+        if not info.is_dir() and info.filename.lower().endswith(IMG_SUFFIX):
+            image_srcs.append(info.filename)
+    return sorted(image_srcs, key=number_to_fixed_digits)
+
+
+class ViewFile(io.RawIOBase):
+    """Read-only file over a memoryview, without copying it"""
+
+    def __init__(self, view):
+        super().__init__()
+        self.view = view
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = max(0, min(len(b), len(self.view) - self.pos))
+        b[:n] = self.view[self.pos : self.pos + n]
+        self.pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.pos, io.SEEK_END: len(self.view)}
+        self.pos = max(0, base[whence] + offset)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+
+class MappedZip:
+    """
+    Zip file mapped into memory (the page cache is shared by the workers).
+    Stored members are read as slices of the mapping; deflated ones are
+    decompressed while read.
+    """
+
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.archive = zipfile.ZipFile(ViewFile(memoryview(self.map)))
+        self.images = zip_images(self.archive)
+
+    def open(self, name):
+        """File object of a member"""
+        info = self.archive.getinfo(name)
+        if info.compress_type != zipfile.ZIP_STORED or info.flag_bits & 0x1:
+            return self.archive.open(info)
+
+        # Data follows the local header: 30 bytes, the name and extra field
+        name_len, extra_len = struct.unpack_from(
+            "<HH", self.map, info.header_offset + 26
+        )
+        start = info.header_offset + 30 + name_len + extra_len
+        return ViewFile(memoryview(self.map)[start : start + info.file_size])
+
+
+@functools.lru_cache(maxsize=ZIP_MAP_CACHE)
+def load_zip_cached(filename, mtime):
+    """Mapped zip kept per worker; mtime is the key for modified files"""
+    return MappedZip(filename)
+
+
+def load_zip(filename):
+    """Mapped zip, without reading the directory again while it is cached"""
+    hits = load_zip_cached.cache_info().hits
+    archive = load_zip_cached(filename, os.path.getmtime(filename))
+    metrics.cache_result("zip_map", load_zip_cached.cache_info().hits > hits)
+    return archive
+
+
+@metrics.timed("zip_read")
+def zipcat(filename, page=None, fit=None):
+    """
+    Get file and number of files in a zip
+    fit: (width, height) -> size to be shown; the image is decoded at the
+    smallest scale still larger than that (JPEG draft, or reduce)
+    """
+    archive = load_zip(filename)
+    if page is None:
+        return len(archive.images)
+
+    # Decoded from the mapping; no copies of the file or the image
+    with archive.open(archive.images[page]) as file:
+        img = Image.open(file)
+        imgtype = img.format
+        target = None
+        if fit is not None:
+            target = fit(*img.size)
+            img.draft(None, target)  # JPEG: 1/2 to 1/8 scale while decoding
+
+        # A giant page must not take all the memory of the worker
+        decoded_bytes = img.width * img.height * len(img.getbands())
+        if decoded_bytes > IMG_DECODE_MAX_BYTES:
+            raise Image.DecompressionBombError(
+                f"Page {page} of {filename} needs {decoded_bytes} bytes to decode"
+            )
+        img.load()
+
+    if target is not None:
+        img = reduced(img, target)
+    return img, imgtype, img.mode
 
-        if page is None:
-            return len(image_srcs)
 
-        with archive.open(image_srcs[page]) as file:
-            img = Image.open(file)
-            imgmode = img.mode
-            imgtype = img.format
-            img = img.copy()
-            return img, imgtype, imgmode
+def reduced(img, target):
+    """Image reduced by an integer factor, still larger than target"""
+    factor = min(img.width // max(target[0], 1), img.height // max(target[1], 1))
+    if factor > 1 and img.mode not in ("1", "P", "I;16"):  # Can't reduce
+        img = img.reduce(factor)
+    return img
+
+
+def contain_size(width, height, box):
+    """Size of the image contained in a box (not enlarged)"""
+    ratio = min(box / width, box / height, 1)
+    return math.ceil(width * ratio), math.ceil(height * ratio)
+
+
+def render_page(book_number, filetype, page, query="", shrink=IMG_SHRINK):
+    """
+    Image of a page of pdf/zip -> (encoded chunks (list of bytes), imgtype)
+    Only takes and returns plain values, so it can run in worker processes.
+    """
+    file_real = os.path.join(UPLOADDIR_PATH, f"{book_number}.{filetype}")
+
+    # Highlights are in colour
+    colors = page_colors(book_number, page) if query == "" else "color"
+    if colors == "bilevel" and not PAGE_BILEVEL_PNG:
+        colors = "gray"
+
+    if filetype == "pdf":
+        file_real = pdf_for_render(book_number, file_real)
+        img = pdf2img(
+            file_real,
+            page=page,
+            dpi=PDF_IMG_DPI,
+            query=query,
+            antialias=colors != "bilevel",  # Sharp edges for 1 bit
+            mode="RGB" if colors == "color" else "L",
+        )
+        imgtype, imgmode = None, None
+    elif filetype == "zip":
+        img, imgtype, imgmode = zipcat(file_real, page=page, fit=shrunk_size)
+    else:
+        raise TypeError(f"Image of {filetype} is not supported")
+
+    return encode_pil_image(
+        img, imgtype=imgtype, imgmode=imgmode, shrink=shrink, colors=colors
+    )
+
+
+@metrics.timed("encode")
+def encode_pil_image(
+    pil_img, imgtype=None, imgmode=None, quality=100, shrink=False, colors="color"
+):
+    """
+    PIL Image -> (encoded chunks (list of bytes), imgtype)
+    colors: "gray" is sent as grayscale JPEG, "bilevel" as 1-bit PNG
+    """
+    if shrink is True or imgtype is not None:  # REFACT consider splitting
+        imgtype = "jpeg"
+        quality = 90
+        imgmode = "RGB"
+
+        size = shrunk_size(*pil_img.size)
+        if size != pil_img.size:
+            if pil_img.mode == "1":
+                pil_img = pil_img.convert("L")  # Shrunk in gray, not dropping dots
+            pil_img = pil_img.resize(size, resample=Image.Resampling.BOX)
+
+    if colors == "gray":
+        imgmode = "L"
+    elif colors == "bilevel":
+        imgtype, imgmode = "png", "1"
+
+    imgtype = imgtype.lower()
+    if pil_img.mode != imgmode:
+        pil_img = pil_img.convert(imgmode, dither=Image.Dither.NONE)
+    chunks = Chunks()
+    pil_img.save(chunks, imgtype, quality=quality)
+    return chunks, imgtype
+
+
+class Chunks(list):
+    """Encoded data in the pieces written by the encoder, sent without joining"""
+
+    def write(self, data):
+        self.append(bytes(data))  # No copy for bytes
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def shrunk_size(width, height):
+    """Size of the image after shrinking for transfer"""
+    if width >= height and width > IMG_SHRINK_WIDTH:
+        width, height = IMG_SHRINK_WIDTH, height * IMG_SHRINK_WIDTH // width
+    if height >= width and height > IMG_SHRINK_HEIGHT:
+        width, height = width * IMG_SHRINK_HEIGHT // height, IMG_SHRINK_HEIGHT
+    return width, height
 
 
 def resize_keep_aspect(img, width=None, height=None, resample=Image.Resampling.BOX):
@@ -231,6 +653,11 @@ TWOBYTE_CHARS = "|".join(
         r"[\uD840-\uD87F\uDC00-\uDFFF\u3000-\u303F]",
     ]
 )
+# Same in one class
+TWOBYTE_CLASS = (
+    r"[\u3041-\u3096\u30A1-\u30FA々〇〻\u3400-\u9FFF\uF900-\uFAFF"
+    r"\uD840-\uD87F\uDC00-\uDFFF\u3000-\u303F]"
+)
 
 
 def ngram_if_2byte(text, gram_n=2):
@@ -247,41 +674,52 @@ def ngram_if_2byte(text, gram_n=2):
     return text
 
 
+# OCR text cleanup, precompiled
+OCR_SPACES = re.compile("[ 　\t,\"'●■□一]+")
+OCR_SPACED_DOTS = re.compile(". . ")
+# Whitespace between 2-byte chars (wrongly inserted by Japanese OCR);
+# starts with the whitespace, so that only whitespaces are examined
+OCR_TWOBYTE_GAP = re.compile(f" (?<={TWOBYTE_CLASS} )(?={TWOBYTE_CLASS})")
+OCR_DOTS = re.compile(r"[\.,\"'●■□~=ー\−]{2,}")
+
+
 def clean_ocr_text(t):
     """Cleanup dirty OCRed text"""
+    return clean_ocr_pages([t])[0]
+
 
+def clean_ocr_pages(pages):
+    """
+    Cleanup dirty OCRed texts at once (a list of pages).
+    Each step runs once over all the pages joined by newlines, which no step
+    touches or matches across.
+    """
     # Join to one line
-    t = "".join(t.splitlines()).strip()
+    t = "\n".join("".join(p.splitlines()).strip() for p in pages)
 
     # Remove extra whitespaces
-    t = re.sub("[ 　\t,\"'●■□一]+", " ", t)
-    t = re.sub(". . ", "", t)
+    t = OCR_SPACES.sub(" ", t)
+    t = OCR_SPACED_DOTS.sub("", t)
 
     # Remove errornous whitespaces in Japanese OCR
-    for _ in range(3):
-        t = re.sub(f"({TWOBYTE_CHARS}+)[ \t　]({TWOBYTE_CHARS}+)", "\\1\\2", t)
+    # (whitespaces are single here, so one pass joins all)
+    t = OCR_TWOBYTE_GAP.sub("", t)
 
     # Remove ligartures (fi, fl and so on)
     t = unicodedata.normalize("NFKC", t)
 
     # Remove errornous dots
-    t = re.sub(r"[\.,\"'●■□~=ー\−][\.,\"'●■□~=ー\−]+", "", t)
+    t = OCR_DOTS.sub("", t)
 
-    return t
+    return t.split("\n")
 
 
+@metrics.timed("pdf_text")
 def pdf2txt(pdf_path):
     """Extract PDF text per page"""
-    pdf = poppler.load_from_file(pdf_path)
-    pages = []
-    for i in range(pdf.pages):
-        # Extraction
-        t = pdf.create_page(i).text()
-        # Clean up
-        t = clean_ocr_text(t)
-        # Finally append
-        pages.append(t)
-    return pages
+    pdf = load_pdf(pdf_path)
+    pages = [pdf.create_page(i).text() for i in range(pdf.pages)]
+    return clean_ocr_pages(pages)
 
 
 def excerpt(txt, start, end, length):
@@ -294,6 +732,74 @@ def excerpt(txt, start, end, length):
     return txt[start:end]
 
 
+def query_cleaner(query):
+    """Cleanup messy query"""
+    query = query.replace("\u3000", " ")  # full-width space
+    query = re.sub(r" ([\&\+\(\)\*\\\#]) ", r"\1", query)  # Care for orphan symbols
+
+    # (i) For western languages
+    query_quoted = " ".join([f'"{q}"' for q in query.split(" ")])
+
+    # (ii) for languages without delimiter
+    ngram_ary = [f'"{n_gram(q)}"' if len(q) > 1 else q for q in query.split(" ")]
+    query_ngram = "(" + " ".join(ngram_ary) + ")"
+
+    # (iii) (i) and (ii) are merged
+    query_merged = query_quoted + " OR " + query_ngram
+    return query_merged
+
+
+def search_books(cursor, query_merged, filters="1", params=None, number=0):
+    """
+    Books matching the full-text query (made by query_cleaner)
+    filters: SQL condition on books, with its params
+    -> ({number: {number, score, filetype, tags}}, numbers hit by title or tags)
+    """
+    params = dict(params or {}, textquery=query_merged)
+
+    # Books hit by page text, scored by the best page (bm25 works only
+    # while the hits are not flattened into the aggregate)
+    with metrics.timer("fmfm_stage_seconds", stage="search_fts"):
+        cursor.execute(
+            f"""
+            with hits as materialized (
+                select number, bm25(fts) as score from fts
+                where ngram match :textquery
+            )
+            select books.number, min(hits.score) as score, books.filetype, books.tags
+            from hits join books on books.number = hits.number
+            where {filters}
+            group by books.number
+            """,
+            params,
+        )
+        hits = {r["number"]: dict(r) for r in cursor.fetchall()}
+
+    # Title and tags (own index, weighted to rank over page text)
+    meta_hits = set()
+    if number == 0:
+        with metrics.timer("fmfm_stage_seconds", stage="search_meta"):
+            cursor.execute(
+                f"""
+                select books.number, books.filetype, books.tags,
+                bm25(meta_fts, :title_weight, :tags_weight) as score
+                from meta_fts join books on books.number = meta_fts.rowid
+                where meta_fts match :textquery and {filters}
+                """,
+                params
+                | {
+                    "title_weight": SEARCH_TITLE_WEIGHT,
+                    "tags_weight": SEARCH_TAGS_WEIGHT,
+                },
+            )
+            for r in cursor.fetchall():
+                meta_hits.add(r["number"])
+                hit = hits.setdefault(r["number"], dict(r))
+                hit["score"] = min(hit["score"], r["score"])
+
+    return hits, meta_hits
+
+
 def show_hit_text(text, query):
     """Search result to showable format"""
     hit_excerpt = ""
@@ -373,9 +879,11 @@ def register_file(a_file, database):
 
         # Seems OK so I'll insert the entry into the DB
         cursor.execute(
-            "insert into books (number, title, filetype, md5, tags) values (?, ?, ?, ?, ?)",
+            "insert into books (number, title, filetype, md5, tags, registered_date)"
+            " values (?, ?, ?, ?, ?, datetime('now', 'localtime'))",
             (new_number, basename, filetype, hash_md5, ""),
         )
+        index_metadata(new_number, cursor)
 
     except sqlite3.Error as e:
         # Clean up the file
@@ -390,141 +898,868 @@ def register_file(a_file, database):
     return new_number
 
 
-def refresh_entry(book_number, database, extract_title=False):
-    """Make a thumbnail and text index"""
-    cursor = database.cursor()
-    cursor.execute("select * from books where number = ?", (book_number,))
-    entry = cursor.fetchone()
+# EPUB reading straight from the zip container
+class HTMLTextExtractor(HTMLParser):
+    """Collects text in <body>, without building a tree"""
+
+    SKIP_TAGS = ("script", "style")
+    # Paragraph boundaries are kept as newlines
+    BLOCK_TAGS = (
+        "p div br li tr h1 h2 h3 h4 h5 h6 section blockquote pre table dt dd".split()
+    )
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.texts = []
+        self.in_body = False
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "body":
+            self.in_body = True
+        elif tag in self.SKIP_TAGS:
+            self.skipping += 1
+        elif tag in self.BLOCK_TAGS:
+            self.handle_data("\n")
+
+    def handle_endtag(self, tag):
+        if tag == "body":
+            self.in_body = False
+        elif tag in self.SKIP_TAGS and self.skipping > 0:
+            self.skipping -= 1
+        elif tag in self.BLOCK_TAGS:
+            self.handle_data("\n")
+
+    def handle_data(self, data):
+        if self.in_body and self.skipping == 0:
+            self.texts.append(data)
+
+
+def html_to_text(html):
+    """Text in the body of (X)HTML"""
+    parser = HTMLTextExtractor()
+    parser.feed(html)
+    parser.close()
+    return "".join(parser.texts)
+
+
+def chunk_text(text, size=EPUB_CHUNK_CHARS):
+    """
+    Split text into chunks of about the size, at paragraph (newline) boundaries.
+    Yields (offset, chunk); a paragraph longer than the size is cut (at a space).
+    """
+    chunk_start = pos = 0
+    for para in text.splitlines(keepends=True):
+        para_end = pos + len(para)
+        if para_end - chunk_start > size and pos > chunk_start:
+            yield chunk_start, text[chunk_start:pos]
+            chunk_start = pos
+        while para_end - chunk_start > size:
+            # Cut at a whitespace if possible
+            cut = text.rfind(" ", chunk_start + 1, chunk_start + size) + 1
+            cut = cut if cut > 0 else chunk_start + size
+            yield chunk_start, text[chunk_start:cut]
+            chunk_start = cut
+        pos = para_end
+
+    if chunk_start < len(text):
+        yield chunk_start, text[chunk_start:]
+
+
+def epub_package(archive):
+    """
+    Read the OPF of EPUB (zipfile.ZipFile).
+    Returns dict of title, spine (paths of linear documents) and cover path.
+    """
+    container = ElementTree.fromstring(archive.read("META-INF/container.xml"))
+    opf_path = container.find(".//{*}rootfile").get("full-path")
+    opf = ElementTree.fromstring(archive.read(opf_path))
+
+    def resolve(href):
+        """href in OPF -> path in zip"""
+        return posixpath.normpath(
+            posixpath.join(posixpath.dirname(opf_path), unquote(href))
+        )
+
+    manifest = {i.get("id"): i for i in opf.iterfind(".//{*}item")}
+
+    # * Reordered as specified in spine.
+    spine = [
+        resolve(manifest[i.get("idref")].get("href"))
+        for i in opf.iterfind(".//{*}itemref")
+        if i.get("linear", "yes") == "yes" and i.get("idref") in manifest
+    ]
+
+    # EPUB3
+    covers = [
+        i for i in manifest.values() if "cover-image" in i.get("properties", "").split()
+    ]
+    # EPUB2
+    covers += [
+        manifest[m.get("content")]
+        for m in opf.iterfind(".//{*}meta")
+        if m.get("name") == "cover" and m.get("content") in manifest
+    ]
+
+    title = opf.find(".//{*}metadata/{*}title")
+    return {
+        "title": title.text.strip() if title is not None and title.text else None,
+        "spine": spine,
+        "cover": resolve(covers[0].get("href")) if covers else None,
+    }
+
+
+def epub_index(book_number, file_real):
+    """Generator of FTS rows of EPUB, reading one spine document at a time"""
+    with zipfile.ZipFile(file_real) as archive:
+        for pos, path in enumerate(epub_package(archive)["spine"]):
+            try:
+                content = archive.read(path).decode("utf-8", errors="replace")
+            except KeyError:
+                continue  # Missing in the container
+
+            text = html_to_text(content)
+
+            # * Each 'item' of epub can be long, so here to split them into chunks.
+            # Position is item + offset ratio of the chunk, so that Bibi can jump.
+            for offset, chunk in chunk_text(text):
+                chunk = re.sub(r"\s+", " ", chunk).strip()
+                if len(chunk) == 0:
+                    continue
+                minipos = min(round(offset / len(text), 3), 0.999)
+                yield (book_number, pos + minipos, ngram_if_2byte(chunk))
+
+
+# Cache files
+def write_atomic(path, content):
+    """Write text or bytes aside and rename, for requests reading it meanwhile"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    if isinstance(content, bytes):
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+    else:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(content)
+    os.replace(tmp_path, path)
+
+
+@metrics.timed("precompress")
+def precompress(file_real):
+    """Write gzip (and brotli if available) variants next to the file"""
+    with open(file_real, "rb") as f:
+        data = f.read()
+    write_atomic(file_real + ".gz", gzip.compress(data, compresslevel=9, mtime=0))
+    if brotli is not None:
+        write_atomic(file_real + ".br", brotli.compress(data))
+
+
+def prune_cache(directory, keep):
+    """Remove older files than the newest 'keep' files"""
+    cached = []
+    for f in os.scandir(directory):
+        if f.name.endswith((".lock", ".tmp")):
+            continue  # In use by a request being processed
+        try:
+            cached.append((f.stat().st_mtime, f.path))
+        except FileNotFoundError:
+            pass  # Removed by another process
+
+    for _, path in sorted(cached)[:-keep]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+# Markdown rendering, cached by the content hash
+def render_markdown(md):
+    """Markdown -> (HTML, plain text)"""
+    key = hashlib.sha1(md.encode()).hexdigest()
+    html_real = os.path.join(MD_CACHE_PATH, f"{key}.html")
+    text_real = os.path.join(MD_CACHE_PATH, f"{key}.txt")
+
+    try:
+        with open(html_real, encoding="utf-8") as f:
+            html = f.read()
+        with open(text_real, encoding="utf-8") as f:
+            text = f.read()
+        metrics.cache_result("markdown", True)
+        return html, text
+    except FileNotFoundError:
+        metrics.cache_result("markdown", False)
+
+    from bs4 import BeautifulSoup
+
+    html = md_ext(md)
+    soup = BeautifulSoup(html, features="html.parser")
+    text = soup.get_text().strip().replace("\n", " ")
+
+    os.makedirs(MD_CACHE_PATH, exist_ok=True)
+    write_atomic(html_real, html)
+    write_atomic(text_real, text)
+    prune_cache(MD_CACHE_PATH, MD_CACHE_MAX * 2)  # HTML and text per note
+    return html, text
 
+
+# Title and tags index
+def index_metadata(book_number, cursor):
+    """Put title and tags of the book into meta_fts (not committed)"""
+    cursor.execute("select title, tags from books where number = ?", (book_number,))
+    entry = cursor.fetchone()
+    cursor.execute("delete from meta_fts where rowid = ?", (book_number,))
     if entry is None:
-        raise IndexError(f"No entry #{book_number} found")
+        return
+    title = ngram_if_2byte(entry[0] or "")
+    tags = " ".join(ngram_if_2byte(t) for t in (entry[1] or "").split())  # Each tag
+    cursor.execute(
+        "insert into meta_fts (rowid, title, tags) values (?, ?, ?)",
+        (book_number, title, tags),
+    )
+
+
+# Metadata editing
+EDIT_FLAGS = ("r2l", "spread", "hide")  # Columns set by checkboxes (1 or 0)
+column_types = {}  # Column name -> type of books, read once per process
+
+
+def book_column_types(cursor):
+    """Column name -> type of books table"""
+    if not column_types:
+        cursor.execute("select name, type from pragma_table_info('books')")
+        column_types.update((r[0], r[1]) for r in cursor.fetchall())
+    return column_types
 
-    filetype = entry["filetype"]
+
+def edit_books(numbers, cursor, add_tags=(), remove_tags=(), flags=None):
+    """
+    Add/remove tags and set flags (EDIT_FLAGS -> bool) of the books at once,
+    not committed; only the books whose tags changed are indexed again.
+    Returns the number of books found.
+    """
+    selection = json.dumps([int(n) for n in numbers])  # Any number of books
+    cursor.execute(
+        "select number, tags from books"
+        " where number in (select value from json_each(?))",
+        (selection,),
+    )
+    entries = cursor.fetchall()
+
+    retagged = []
+    for number, tags in entries:
+        old_tags = (tags or "").split()
+        new_tags = [t for t in old_tags if t not in remove_tags]
+        new_tags += [t for t in dict.fromkeys(add_tags) if t not in new_tags]
+        if new_tags != old_tags:
+            retagged.append((" ".join(new_tags), number))
+    cursor.executemany("update books set tags = ? where number = ?", retagged)
+
+    for key, value in (flags or {}).items():
+        if key not in EDIT_FLAGS or book_column_types(cursor).get(key) != "INTEGER":
+            raise KeyError(f"{key} cannot be set")
+        cursor.execute(
+            f"update books set {key} = ?"
+            " where number in (select value from json_each(?))",
+            (int(bool(value)), selection),
+        )
+
+    for _, number in retagged:
+        index_metadata(number, cursor)
+    return len(entries)
+
+
+# Thumbnails
+def thumbnail_path(book_number, size="large", imgtype="jpeg"):
+    """Path of a thumbnail (large JPEG keeps the traditional name)"""
+    if size == "large" and imgtype == "jpeg":
+        filename = f"{book_number}.jpg"
+    else:
+        filename = f"{book_number}_{size}.{THUMB_FORMATS[imgtype]}"
+    return os.path.join(THUMBDIR_PATH, filename)
+
+
+@metrics.timed("thumbnails")
+def save_thumbnails(book_number, cover):
+    """Shrink the cover image into every thumbnail size and format"""
+    cover = cover.convert("RGB")
+    # Larger first, so each step shrinks the previous (smaller) image
+    for size, box in sorted(THUMB_SIZES.items(), key=lambda s: s[1], reverse=True):
+        cover = ImageOps.contain(cover, (box, box))
+        for imgtype in THUMB_FORMATS:
+            # Written aside and renamed, for requests reading it meanwhile
+            thumb_real = thumbnail_path(book_number, size, imgtype)
+            tmp_real = f"{thumb_real}.{os.getpid()}.tmp"
+            cover.save(tmp_real, imgtype.upper(), quality=THUMB_QUALITY)
+            os.replace(tmp_real, thumb_real)
+
+
+def thumbnail_fit(width, height):
+    """Size of the largest thumbnail of the image"""
+    return contain_size(width, height, max(THUMB_SIZES.values()))
+
+
+def pdf_cover(filename, box=None):
+    """Render the first page of PDF at the lowest DPI that fits the box"""
+    box = box or max(THUMB_SIZES.values())
+    pdf = load_pdf(filename)
+    if pdf.pages == 0:
+        raise IndexError
+
+    rect = pdf.create_page(0).page_rect()  # in points (1/72 inch)
+    dpi = math.ceil(72 * box / max(rect.width, rect.height, 1))
+    return pdf2img(filename, page=0, dpi=dpi)
+
+
+def zip_cover(file_real):
+    """First page of zip, decoded at the scale of the largest thumbnail"""
+    try:
+        return zipcat(file_real, page=0, fit=thumbnail_fit)[0]
+    except Image.DecompressionBombError:
+        # Too big to decode even at reduced scale
+        return Image.new("RGB", (100, 140))
+
+
+def epub_cover(file_real):
+    """Cover image of EPUB; only the image itself is read from the zip"""
+    try:
+        with zipfile.ZipFile(file_real) as archive:
+            cover_bytes = archive.read(epub_package(archive)["cover"])
+        return Image.open(io.BytesIO(cover_bytes))
+
+    except (KeyError, TypeError, OSError):
+        # No thumbnail image was found.
+        return Image.new("RGB", (100, 140))
+
+
+def md_text(file_real):
+    """Plain text of markdown file"""
+    with open(file_real, encoding="utf-8") as fp:
+        md = fp.read()
+    return render_markdown(md)[1]
+
+
+def md_cover(text):
+    """Generate thumbnail with text"""
+    from PIL import ImageFont, ImageDraw
+
+    thumbnail = Image.new("RGB", (100, 140), color=(255, 255, 255))
+    font = ImageFont.truetype("/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc")
+    draw = ImageDraw.Draw(thumbnail)
+    text_w_crlf = "\n".join([text[i : i + 20] for i in range(0, 200, 20)])
+    draw.text((5, 5), text_w_crlf, "#333333", font=font)
+    return thumbnail
+
+
+def cover_image(book_number, filetype):
+    """Cover image of the book, without building its text index"""
+    file_real = os.path.join(UPLOADDIR_PATH, str(book_number) + f".{filetype}")
+
+    if filetype == "zip":
+        return zip_cover(file_real)
+    if filetype == "pdf":
+        return pdf_cover(file_real)
+    if filetype == "epub":
+        return epub_cover(file_real)
+    if filetype == "md":
+        return md_cover(md_text(file_real))
+    raise TypeError(f"Thumbnail of {filetype} is not supported")
+
+
+def make_thumbnails(book_number, filetype):
+    """(Re)generate all the thumbnails of the book"""
+    save_thumbnails(book_number, cover_image(book_number, filetype))
+
+
+def thumbsheet_key(entries):
+    """Cache key of a sprite sheet: entries are (number, md5) of the books"""
+    key_src = ",".join(f"{n}:{md5}" for n, md5 in entries)
+    key_src += f"/{THUMBSHEET_CELL}/{THUMBSHEET_COLUMNS}"
+    return hashlib.sha1(key_src.encode()).hexdigest()[:16]
+
+
+def thumbsheet_path(key, imgtype="jpeg"):
+    """Path of a cached sprite sheet"""
+    return os.path.join(THUMBSHEET_DIR, f"{key}.{THUMB_FORMATS[imgtype]}")
+
+
+@metrics.timed("thumbsheet")
+def make_thumbsheet(entries, sheet_real, imgtype="jpeg"):
+    """
+    Tile thumbnails into one sprite sheet, row by row.
+    entries: (number, filetype) of the books
+    Each thumbnail is contained in a cell, aligned to bottom center.
+    """
+    cell_w, cell_h = THUMBSHEET_CELL
+    rows = math.ceil(len(entries) / THUMBSHEET_COLUMNS)
+    bgcolor = (255, 255, 255, 0) if imgtype == "webp" else (255, 255, 255, 255)
+    sheet = Image.new("RGBA", (cell_w * THUMBSHEET_COLUMNS, cell_h * rows), bgcolor)
+
+    for i, (number, filetype) in enumerate(entries):
+        thumb_real = thumbnail_path(number)
+        try:
+            if not os.path.exists(thumb_real):
+                make_thumbnails(number, filetype)
+            with Image.open(thumb_real) as thumb:
+                thumb = ImageOps.contain(thumb.convert("RGB"), (cell_w, cell_h))
+        except BOOK_FILE_ERRORS:
+            continue  # Leave the cell blank
+
+        row, col = divmod(i, THUMBSHEET_COLUMNS)
+        x = col * cell_w + (cell_w - thumb.width) // 2
+        y = row * cell_h + (cell_h - thumb.height)
+        sheet.paste(thumb, (x, y))
+
+    # Save aside and rename, then drop old sheets
+    os.makedirs(THUMBSHEET_DIR, exist_ok=True)
+    if imgtype == "jpeg":
+        sheet = sheet.convert("RGB")
+    tmp_real = f"{sheet_real}.{os.getpid()}.tmp"
+    sheet.save(tmp_real, imgtype.upper(), quality=THUMB_QUALITY)
+    os.replace(tmp_real, sheet_real)
+
+    prune_cache(THUMBSHEET_DIR, THUMBSHEET_CACHE_MAX)
+
+
+# Page manifest
+def manifest_path(book_number):
+    """Path of the page manifest of a book"""
+    return os.path.join(MANIFEST_DIR, f"{book_number}.json")
+
+
+def page_info(width, height, sample, colors, shrink=True):
+    """Manifest item of a page, sized as /img sends it; sample: small image"""
+    if shrink:
+        width, height = shrunk_size(width, height)
+    return {
+        "width": width,
+        "height": height,
+        "orientation": "landscape" if width > height else "portrait",
+        "color": "#{:02x}{:02x}{:02x}".format(*average_color(sample)),
+        "colors": colors,
+    }
+
+
+def sample_fit(width, height):
+    """Size of the sample of a page for its colours"""
+    return contain_size(width, height, PAGE_SAMPLE_SIZE)
+
+
+def color_class(sample, parts):
+    """
+    "color", "gray" or "bilevel" (black and white) of a page
+    sample: the page reduced (sample_fit)
+    parts: function giving the parts of the page (bilevel_strips) at full
+    size; called only for pages without colour
+    """
+    # Colourful pixels: max - min of RGB is large
+    r, g, b = sample.convert("RGB").split()
+    chroma = ImageChops.subtract(
+        ImageChops.lighter(ImageChops.lighter(r, g), b),
+        ImageChops.darker(ImageChops.darker(r, g), b),
+    )
+    colorful = sum(chroma.histogram()[PAGE_COLOR_MIN_CHROMA:])
+    if colorful > sample.width * sample.height * PAGE_COLOR_MIN_PIXELS:
+        return "color"
+
+    # Black and white: few pixels between them in every part, so that a
+    # picture anywhere keeps the page gray
+    for img in parts():
+        if img.mode == "1":
+            continue
+        midtones = sum(img.convert("L").histogram()[32:224])
+        if midtones > img.width * img.height * PAGE_BILEVEL_MAX_MIDTONES:
+            return "gray"
+    return "bilevel"
+
+
+def bilevel_strips(width, height):
+    """
+    Regions (x, y, w, h) of a page checked for black and white: full-height
+    strips spread across it, so that a picture wider than the gaps meets one
+    """
+    strip_w = min(PAGE_BILEVEL_STRIP_WIDTH, width)
+    step = (width - strip_w) / max(PAGE_BILEVEL_STRIPS - 1, 1)
+    xs = sorted({round(i * step) for i in range(PAGE_BILEVEL_STRIPS)})
+    return [(x, 0, strip_w, height) for x in xs]
+
+
+def average_color(img):
+    """Average colour of the image, (r, g, b)"""
+    return img.convert("RGB").resize((1, 1), Image.Resampling.BOX).getpixel((0, 0))
+
+
+def neutral_page(previous=None):
+    """Manifest item of a page that cannot be read: sized as the previous one"""
+    item = dict(previous or {"width": 1000, "height": 1414, "orientation": "portrait"})
+    item.update(color="#808080", colors="color")
+    return item
+
+
+# Errors of a page image that cannot be read (damaged, not an image, too big)
+PAGE_IMAGE_ERRORS = (
+    OSError,
+    ValueError,
+    zlib.error,
+    zipfile.BadZipFile,
+    Image.DecompressionBombError,
+)
+
+
+def zip_page_info(file_real, page):
+    """
+    Manifest item of a zip page. JPEG is sampled at reduced scale while
+    decoded, and decoded in full only if it has no colour; other formats
+    are decoded in full.
+    """
+    archive = load_zip(file_real)
+    with archive.open(archive.images[page]) as file, Image.open(file) as img:
+        size, imgtype = img.size, img.format  # From the header
+
+    if imgtype == "JPEG":
+        sample = zipcat(file_real, page, fit=sample_fit)[0]
+        full = None
+    else:
+        full = zipcat(file_real, page)[0]
+        sample = reduced(full.convert("RGB"), sample_fit(*size))
+
+    def parts():
+        img = full if full is not None else zipcat(file_real, page)[0]
+        for x, y, w, h in bilevel_strips(*img.size):
+            yield img.crop((x, y, x + w, y + h))
+
+    return page_info(*size, sample, color_class(sample, parts))
+
+
+def zip_manifest(file_real):
+    """Pages of zip: sizes from the headers, colours from decoding"""
+    pages = []
+    for page in range(zipcat(file_real)):
+        try:
+            pages.append(zip_page_info(file_real, page))
+        except PAGE_IMAGE_ERRORS:
+            pages.append(neutral_page(pages[-1] if pages else None))
+    return pages
+
+
+def pdf_page_size(file_real, page, dpi):
+    """Pixel size of PDF page at the DPI, and its sample (sample_fit)"""
+    pdf = load_pdf(file_real)
+    if page >= pdf.pages:
+        raise IndexError
+
+    # Page box is in points (1/72 inch); rotated pages are told by the sample
+    rect = pdf.create_page(page).page_rect()
+    sample_dpi = 72 * PAGE_SAMPLE_SIZE / max(rect.width, rect.height, 1)
+    sample = pdf2img(file_real, page=page, dpi=sample_dpi, antialias=False)
+    width = math.ceil(rect.width * dpi / 72)
+    height = math.ceil(rect.height * dpi / 72)
+    if (sample.width > sample.height) != (width > height):
+        width, height = height, width
+    return (width, height), sample
+
+
+def pdf_page_info(file_real, page):
+    """
+    Manifest item of a PDF page. Black and white is told from strips of the
+    page, rendered at full size as bilevel pages are sent.
+    """
+    (width, height), sample = pdf_page_size(file_real, page, PDF_IMG_DPI)
+
+    def parts():
+        for region in bilevel_strips(width, height):
+            yield pdf2img(
+                file_real, page, PDF_IMG_DPI, antialias=False, region=region, mode="L"
+            )
+
+    return page_info(width, height, sample, color_class(sample, parts), IMG_SHRINK)
+
+
+def pdf_manifest(file_real):
+    """Pages of PDF: sizes at PDF_IMG_DPI, colours from renderings"""
+    return [pdf_page_info(file_real, page) for page in range(load_pdf(file_real).pages)]
+
+
+@functools.lru_cache(maxsize=MANIFEST_CACHE)
+def load_manifest_cached(manifest_real, mtime):
+    """Manifest kept per worker; mtime is the key for remade ones"""
+    with open(manifest_real, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def page_colors(book_number, page):
+    """Colour class of the page told at indexing ("color" if unknown)"""
+    manifest_real = manifest_path(book_number)
+    try:
+        pages = load_manifest_cached(manifest_real, os.path.getmtime(manifest_real))[
+            "pages"
+        ]
+    except FileNotFoundError:
+        return "color"
+    return pages[page].get("colors", "color") if page < len(pages) else "color"
+
+
+@metrics.timed("manifest")
+def make_manifest(book_number, filetype):
+    """Write the page manifest of pdf/zip; returns its path"""
+    file_real = os.path.join(UPLOADDIR_PATH, f"{book_number}.{filetype}")
+    if filetype == "zip":
+        pages = zip_manifest(file_real)
+    elif filetype == "pdf":
+        pages = pdf_manifest(pdf_for_render(book_number, file_real))
+    else:
+        raise TypeError(f"Manifest of {filetype} is not supported")
+
+    os.makedirs(MANIFEST_DIR, exist_ok=True)
+    manifest_real = manifest_path(book_number)
+    write_atomic(manifest_real, json.dumps({"number": book_number, "pages": pages}))
+    return manifest_real
+
+
+# Deep zoom tiles
+def tile_path(book_number, page, z, x, y):
+    """Path of a cached tile"""
+    return os.path.join(TILE_DIR, f"{book_number}_{page}_{z}_{x}_{y}.jpg")
+
+
+def tile_levels(width, height):
+    """Zoom levels of the page: 0 fits in a tile, the last is full size"""
+    return max(0, math.ceil(math.log2(max(width, height) / TILE_SIZE))) + 1
+
+
+def level_size(width, height, z):
+    """Size of the page at zoom level z"""
+    scale = 2 ** (tile_levels(width, height) - 1 - z)
+    return math.ceil(width / scale), math.ceil(height / scale)
+
+
+@functools.lru_cache(maxsize=256)
+def tile_page_size_cached(book_number, filetype, page, mtime):
+    """Size of the page kept per worker; mtime is the key for replaced books"""
+    file_real = os.path.join(UPLOADDIR_PATH, f"{book_number}.{filetype}")
+    if filetype == "zip":
+        archive = load_zip(file_real)
+        with archive.open(archive.images[page]) as file:
+            return Image.open(file).size
+    if filetype == "pdf":
+        file_real = pdf_for_render(book_number, file_real)
+        if page >= load_pdf(file_real).pages:
+            raise IndexError
+        return pdf_page_size(file_real, page, TILE_PDF_DPI)[0]
+    raise TypeError(f"Tiles of {filetype} are not supported")
+
+
+def tile_page_size(book_number, filetype, page):
+    """Size of the page at the deepest zoom level"""
+    file_real = os.path.join(UPLOADDIR_PATH, f"{book_number}.{filetype}")
+    return tile_page_size_cached(
+        book_number, filetype, page, os.path.getmtime(file_real)
+    )
+
+
+def save_tile(img, tile_real):
+    """Write a tile aside and rename"""
+    tmp_real = f"{tile_real}.{os.getpid()}.tmp"
+    img.convert("RGB").save(tmp_real, "JPEG", quality=TILE_QUALITY)
+    os.replace(tmp_real, tile_real)
+
+
+def zip_pyramid(book_number, page):
+    """
+    Cut a zip image into tiles of all the levels at once,
+    so the (maybe huge) image is decoded only once.
+    """
+    file_real = os.path.join(UPLOADDIR_PATH, f"{book_number}.zip")
+    img = zipcat(file_real, page=page)[0]
+    width, height = img.size
+    for z in reversed(range(tile_levels(width, height))):
+        img = img.resize(level_size(width, height, z), Image.Resampling.BOX)
+        for y in range(0, img.height, TILE_SIZE):
+            for x in range(0, img.width, TILE_SIZE):
+                box = (
+                    x,
+                    y,
+                    min(x + TILE_SIZE, img.width),
+                    min(y + TILE_SIZE, img.height),
+                )
+                save_tile(
+                    img.crop(box),
+                    tile_path(book_number, page, z, x // TILE_SIZE, y // TILE_SIZE),
+                )
+
+
+tile_misses = itertools.count(1)  # Tiles made by this process
+
+
+@metrics.timed("tile")
+def render_tile(book_number, filetype, page, z, x, y):
+    """Make the tile (if missing); returns its path"""
+    tile_real = tile_path(book_number, page, z, x, y)
+    if os.path.exists(tile_real):
+        return tile_real
+
+    # Out of the page
+    width, height = tile_page_size(book_number, filetype, page)
+    levels = tile_levels(width, height)
+    level_w, level_h = level_size(width, height, z)
+    if z >= levels or x * TILE_SIZE >= level_w or y * TILE_SIZE >= level_h:
+        raise IndexError
+
+    os.makedirs(TILE_DIR, exist_ok=True)
+    if filetype == "zip":
+        # One request cuts the pyramid; the others wait, then find their tiles
+        lock_real = os.path.join(TILE_DIR, f"{book_number}_{page}.lock")
+        with open(lock_real, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.exists(tile_real):
+                zip_pyramid(book_number, page)
+    else:
+        # Only the region of the tile is rendered
+        file_real = os.path.join(UPLOADDIR_PATH, f"{book_number}.pdf")
+        region = (
+            x * TILE_SIZE,
+            y * TILE_SIZE,
+            min(TILE_SIZE, level_w - x * TILE_SIZE),
+            min(TILE_SIZE, level_h - y * TILE_SIZE),
+        )
+        dpi = TILE_PDF_DPI / 2 ** (levels - 1 - z)
+        img = pdf2img(
+            pdf_for_render(book_number, file_real), page, dpi=dpi, region=region
+        )
+        save_tile(img, tile_real)
+
+    # Scanning the tile directory is slow: done once in a while
+    if next(tile_misses) % TILE_PRUNE_INTERVAL == 0:
+        prune_cache(TILE_DIR, TILE_CACHE_MAX)
+    return tile_real
+
+
+def remove_tiles(book_number):
+    """Remove cached tiles of the book"""
+    prefix = f"{book_number}_"
+    try:
+        for f in os.scandir(TILE_DIR):
+            if f.name.startswith(prefix):
+                os.remove(f.path)
+    except FileNotFoundError:
+        pass
+
+
+@metrics.timed("extract")
+def extract_entry(book_number, filetype, extract_title=False):
+    """
+    Make a thumbnail and extract page number, title and text index of a file.
+    This touches no DB, so it can run in worker processes.
+    """
     filename = str(book_number) + f".{filetype}"
-    file_thumbnail = str(book_number) + ".jpg"
     file_real = os.path.join(UPLOADDIR_PATH, filename)
-    thumb_real = os.path.join(THUMBDIR_PATH, file_thumbnail)
 
-    book_title = entry["title"]
+    book_title = None
     index_data = []
 
     # ---- FILE TYPE DEPENDENT ---- #
     if filetype == "zip":
         pagenum = zipcat(file_real)
-        thumbnail, _, _ = zipcat(file_real, page=0)
+        thumbnail = zip_cover(file_real)
 
     if filetype == "md":
         pagenum = 0  # STUB
 
+        # Variants for transfer
+        if filetype in PRECOMPRESS_FILETYPES:
+            precompress(file_real)
+
         # Text to FTS
-        with open(file_real, encoding="utf-8") as fp:
-            md = fp.read()
-        soup = BeautifulSoup(md_ext(md), features="html.parser")
-        text = soup.get_text().strip().replace("\n", " ")
+        text = md_text(file_real)
         ngrammed = ngram_if_2byte(text)
         index_data.append((book_number, pagenum, ngrammed))
 
-        # Generate thumbnail with text
-        thumbnail = Image.new("RGB", (100, 140), color=(255, 255, 255))
-        font = ImageFont.truetype(
-            "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc"
-        )
-        draw = ImageDraw.Draw(thumbnail)
-        text_w_crlf = "\n".join([text[i : i + 20] for i in range(0, 200, 20)])
-        draw.text((5, 5), text_w_crlf, "#333333", font=font)
+        thumbnail = md_cover(text)
 
     if filetype == "pdf":
-        pdf = poppler.load_from_file(file_real)
+        pdf = load_pdf(file_real)
+
+        # Big PDF: linearized copy for faster first page
+        linearize_pdf(book_number, file_real)
 
         # Metadata Extraction
         pagenum = pdf.pages
-        thumbnail = pdf2img(file_real)
+        thumbnail = pdf_cover(file_real)
         if extract_title and pdf.title:
             book_title = pdf.title
 
         # Generate text index
         # * Maybe really slow. consider optimization.
         page_ngram = [ngram_if_2byte(p) for p in pdf2txt(file_real)]
-        index_data = tuple(
-            (book_number, pos, text) for pos, text in enumerate(page_ngram)
-        )
+        index_data = [(book_number, pos, text) for pos, text in enumerate(page_ngram)]
 
     if filetype == "epub":
-        book = epub.read_epub(file_real)
+        with zipfile.ZipFile(file_real) as archive:
+            package = epub_package(archive)
 
-        # Thumbnail
-        try:
-            cover_items = [i for i in book.get_items() if isinstance(i, epub.EpubCover)]
-            if cover_items:
-                # EPUB3
-                cover_item = cover_items[0]
-            else:
-                # EPUB2
-                cover_metadata = book.get_metadata("OPF", "cover")
-                cover_id = cover_metadata[0][1]["content"]
-                cover_item = book.get_item_with_id(cover_id)
-
-            cover_bytes = cover_item.get_content()
-            thumbnail = Image.open(io.BytesIO(cover_bytes))
-
-        except IndexError:
-            # No thumbnail image was found.
-            thumbnail = Image.new("RGB", (100, 140))
-
-        # N-Gram and insert into FTS
-        # * We need to reorder the items specified in spine.
-        spine_list = [s[0] for s in book.spine if s[1] == "yes"]
-        items_in_spine = [book.get_item_with_id(i) for i in spine_list]
-        pagenum = len(items_in_spine)
-
-        # * Each 'item' of epub can be long, so here to split them into small chunks.
-        # TODO: section size dependent chunk size?
-        for pos, section in enumerate(items_in_spine):
-            content = section.get_body_content().decode()
-            soup = BeautifulSoup(content, features="html.parser")
-            text = soup.get_text()
-
-            text = text.strip().replace("\n", " ")
-            if len(text) == 0:
-                continue
-
-            chunk_length = math.ceil(len(text) / EPUB_CHUNK_SPLIT)
-            chunks = [
-                text[i : i + chunk_length] for i in range(0, len(text), chunk_length)
-            ]
-            for p, chunk in enumerate(chunks):
-                minipos = round(p / EPUB_CHUNK_SPLIT, 2)
-                chunk_ngram = ngram_if_2byte(chunk)
-                index_data.append((book_number, pos + minipos, chunk_ngram))
-
-        # Title and author from metadata
-        book_title_meta = book.get_metadata("DC", "title")
-        if book_title_meta and extract_title:
-            book_title = book_title_meta[0][0]
+        thumbnail = epub_cover(file_real)
+        pagenum = len(package["spine"])
+
+        # N-Gram and insert into FTS; rows are generated while inserted
+        index_data = epub_index(book_number, file_real)
+
+        # Title from metadata
+        if extract_title and package["title"]:
+            book_title = package["title"]
 
     # ---- COMMON ---- #
+    # Shrink and save thumbnails
+    save_thumbnails(book_number, thumbnail)
+
+    # Page sizes and colours for the viewer (remade on request if it fails)
+    if filetype in ("pdf", "zip"):
+        try:
+            make_manifest(book_number, filetype)
+        except (*BOOK_FILE_ERRORS, *PAGE_IMAGE_ERRORS):
+            pass
+
+    # MD5 hash
+    with open(file_real, "rb") as f:
+        hash_md5 = hashlib.md5(f.read()).hexdigest()
+
+    return {
+        "pagenum": pagenum,
+        "title": book_title,
+        "index_data": index_data,  # Can be a generator
+        "md5": hash_md5,
+    }
+
+
+@metrics.timed("store")
+def store_entry(entry, extracted, cursor, clear_index=True):
+    """
+    Write the result of extract_entry into the DB (not committed).
+    entry: sqlite3 Row of the book
+    clear_index: False if the caller already removed the old FTS rows
+    """
+    book_number = entry["number"]
+
     # Page number update
     cursor.execute(
-        "update books set pagenum = ? where number = ?", (pagenum, book_number)
+        "update books set pagenum = ? where number = ?",
+        (extracted["pagenum"], book_number),
     )
 
-    # FTS update (if available)
-    if len(index_data) > 0:
-        index_data = tuple(index_data)
+    # FTS update (if available), inserted in bounded batches
+    index_data = iter(extracted["index_data"])
+    rows = list(itertools.islice(index_data, FTS_INSERT_BATCH))
+    if len(rows) > 0 and clear_index:
         cursor.execute("delete from fts where number = ?", (book_number,))
+    while len(rows) > 0:
         cursor.executemany(
-            "insert into fts (number, page, ngram) values (?, ?, ?)", index_data
+            "insert into fts (number, page, ngram) values (?, ?, ?)", rows
         )
-
-    # Shrink and save thumbnail
-    thumbnail = thumbnail.convert("RGB")
-    thumbnail = ImageOps.contain(thumbnail, (400, 400))
-    thumbnail.save(thumb_real, "JPEG")
+        rows = list(itertools.islice(index_data, FTS_INSERT_BATCH))
 
     # Book title update
-    cursor.execute(
-        "update books set title = ? where number = ?", (book_title, book_number)
-    )
+    if extracted["title"]:
+        cursor.execute(
+            "update books set title = ? where number = ?",
+            (extracted["title"], book_number),
+        )
 
     # Spread view: 1=True, 0=False
     if entry["spread"] is None:
@@ -545,9 +1780,27 @@ def refresh_entry(book_number, database, extract_title=False):
         )
 
     # Update MD5 hash
-    with open(file_real, "rb") as f:
-        hash_md5 = hashlib.md5(f.read()).hexdigest()
-    cursor.execute("update books set md5 = ? where number = ?", (hash_md5, book_number))
+    cursor.execute(
+        "update books set md5 = ? where number = ?", (extracted["md5"], book_number)
+    )
+
+    # Title may be replaced
+    index_metadata(book_number, cursor)
+
+
+def refresh_entry(book_number, database, extract_title=False):
+    """Make a thumbnail and text index"""
+    cursor = database.cursor()
+    cursor.execute("select * from books where number = ?", (book_number,))
+    entry = cursor.fetchone()
+
+    if entry is None:
+        raise IndexError(f"No entry #{book_number} found")
+
+    extracted = extract_entry(
+        book_number, entry["filetype"], extract_title=extract_title
+    )
+    store_entry(entry, extracted, cursor)
 
     # Finally commit
     cursor.connection.commit()
@@ -566,12 +1819,32 @@ def remove_entry(number, database):
     # * slow! what is the reason?
     cursor.execute("delete from books where number = ?", (number,))
     cursor.execute("delete from fts where number = ?", (number,))
+    cursor.execute("delete from meta_fts where rowid = ?", (number,))
     cursor.connection.commit()
 
-    try:
-        # Remove the book file
-        os.remove(os.path.join(UPLOADDIR_PATH, str(number) + "." + filetype))
-        # Remove thumbnail image
-        os.remove(os.path.join(THUMBDIR_PATH, str(number) + ".jpg"))
-    except FileNotFoundError:
-        pass
+    # Remove the book file and its compressed variants
+    file_real = os.path.join(UPLOADDIR_PATH, str(number) + "." + filetype)
+    for path in (file_real, file_real + ".gz", file_real + ".br"):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    # Remove linearized copy
+    if os.path.exists(linearized_path(number)):
+        os.remove(linearized_path(number))
+
+    # Remove page manifest
+    if os.path.exists(manifest_path(number)):
+        os.remove(manifest_path(number))
+
+    # Remove deep zoom tiles
+    remove_tiles(number)
+
+    # Remove thumbnail images
+    for size in THUMB_SIZES:
+        for imgtype in THUMB_FORMATS:
+            try:
+                os.remove(thumbnail_path(number, size, imgtype))
+            except FileNotFoundError:
+                pass